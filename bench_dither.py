@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Floyd-Steinberg 抖动基准测试：原逐像素实现 vs 编译内核 / NumPy回退实现
+
+用法:
+  python bench_dither.py                    # 使用合成的800x480渐变+噪声图像
+  python bench_dither.py photo.jpg          # 使用真实图片（缩放到800x480）
+  python bench_dither.py --repeat 5 --palette e7
+"""
+
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from convnew.dither import diffuse_indices, FLOYD_STEINBERG, HAVE_NUMBA
+
+E6_COLORS = np.array([
+    [0, 0, 0], [255, 255, 255], [255, 255, 0],
+    [255, 0, 0], [0, 0, 255], [0, 255, 0]
+], dtype=np.float32)
+E7_COLORS = np.vstack([E6_COLORS, [[255, 128, 0]]]).astype(np.float32)
+
+
+def reference_floyd_steinberg(img_array, colors):
+    """原始的逐像素Python实现（作为基准与正确性参照）"""
+    def find_nearest_color(pixel, colors):
+        pixel = np.asarray(pixel, dtype=np.float32)
+        distances = np.sum((colors - pixel) ** 2, axis=1)
+        return colors[np.argmin(distances)].astype(np.uint8)
+
+    height, width = img_array.shape[:2]
+    img_float = img_array.astype(np.float64).copy()
+    error_coeffs = [(1, 0, 7/16), (-1, 1, 3/16), (0, 1, 5/16), (1, 1, 1/16)]
+    for y in range(height):
+        for x in range(width):
+            old_pixel = np.clip(img_float[y, x], 0, 255)
+            new_pixel = find_nearest_color(old_pixel, colors)
+            img_float[y, x] = new_pixel
+            error = old_pixel - new_pixel
+            for dx, dy, coeff in error_coeffs:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < width and 0 <= ny < height:
+                    img_float[ny, nx] = np.clip(img_float[ny, nx] + error * coeff, 0, 255)
+    return img_float.astype(np.uint8)
+
+
+def synthetic_frame(width, height, seed=0):
+    """生成渐变+噪声的合成测试帧"""
+    rng = np.random.default_rng(seed)
+    xs = np.linspace(0, 255, width)[np.newaxis, :]
+    ys = np.linspace(0, 255, height)[:, np.newaxis]
+    frame = np.stack([np.broadcast_to(xs, (height, width)),
+                      np.broadcast_to(ys, (height, width)),
+                      (xs + ys) / 2], axis=2)
+    frame = frame + rng.normal(0, 12, frame.shape)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def best_time(func, repeat):
+    """运行多次，返回最短耗时（秒）和最后一次的结果"""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Floyd-Steinberg 抖动基准测试')
+    parser.add_argument('image', nargs='?', help='测试图片（默认使用合成图像）')
+    parser.add_argument('--width', type=int, default=800)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--palette', choices=['e6', 'e7'], default='e6')
+    parser.add_argument('--repeat', type=int, default=3, help='编译/向量化实现的重复次数')
+    parser.add_argument('--skip-reference', action='store_true',
+                        help='跳过原始逐像素实现（它需要数十秒）')
+    args = parser.parse_args()
+
+    if args.image:
+        img = Image.open(args.image).convert('RGB').resize((args.width, args.height))
+        frame = np.array(img, dtype=np.uint8)
+    else:
+        frame = synthetic_frame(args.width, args.height)
+    colors = E6_COLORS if args.palette == 'e6' else E7_COLORS
+    palette = colors.astype(np.uint8)
+
+    print(f'图像: {args.image or "合成图像"} {args.width}x{args.height}, 调色板: {args.palette.upper()}')
+    print('-' * 60)
+
+    results = {}
+    engines = ['numpy'] + (['numba'] if HAVE_NUMBA else [])
+    for engine in engines:
+        if engine == 'numba':
+            # 首次调用包含JIT编译（或加载磁盘缓存）时间，单独统计
+            start = time.perf_counter()
+            diffuse_indices(frame[:2, :2], colors, FLOYD_STEINBERG, engine='numba')
+            print(f'numba 编译/加载缓存: {(time.perf_counter() - start) * 1000:.1f} ms')
+        seconds, indices = best_time(
+            lambda: diffuse_indices(frame, colors, FLOYD_STEINBERG, engine=engine), args.repeat)
+        results[engine] = (seconds, palette[indices])
+        print(f'{engine:>9}: {seconds * 1000:10.1f} ms/帧')
+    if not HAVE_NUMBA:
+        print('    numba: 未安装，跳过')
+
+    if not args.skip_reference:
+        seconds, reference = best_time(lambda: reference_floyd_steinberg(frame, colors), 1)
+        print(f'{"原实现":>7}: {seconds * 1000:10.1f} ms/帧')
+        print('-' * 60)
+        for engine, (engine_seconds, output) in results.items():
+            identical = np.array_equal(output, reference)
+            print(f'{engine:>9}: 加速 {seconds / engine_seconds:8.1f}x, '
+                  f'输出{"逐像素一致" if identical else "不一致!"}')
+
+
+if __name__ == '__main__':
+    main()
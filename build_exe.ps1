@@ -11,6 +11,7 @@ if (-not (pip show pyinstaller 2>$null)) {
 }
 
 # 2. 执行打包
-pyinstaller --onefile --name convert_main .\convnew\main.py
+# --paths . 让 PyInstaller 从仓库根目录找到 convnew 包（main.py 使用 convnew.* 绝对导入）
+pyinstaller --onefile --name convert_main --paths . .\convnew\main.py
 
 Write-Host "打包完成，生成的 exe 文件在 dist 目录下。"
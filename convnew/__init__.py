@@ -0,0 +1,13 @@
+"""E Ink E6/E7 墨水屏图像转换工具"""
+
+__version__ = '0.1.0'
+
+__all__ = ['convert', 'convert_batch']
+
+
+def __getattr__(name):
+    # 按需导入：python -m convnew.main 运行时，convnew.main 不会在执行前被包导入一次
+    if name in __all__:
+        from convnew import main
+        return getattr(main, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
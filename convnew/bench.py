@@ -0,0 +1,358 @@
+#encoding: utf-8
+"""转换流程各阶段的基准测试（convnew bench）
+
+对合成图像和真实图片，在多种分辨率和调色板下分别测量每个阶段的耗时
+（多次运行取最短）和峰值内存（tracemalloc，单独运行一次以免影响计时），
+结果可保存为JSON，并与之前保存的基线比较以发现性能回退。
+--quality 对每种颜色距离度量比较画质（与预处理后图像的平均 CIEDE2000 色差）和速度。
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from convnew import __version__
+from convnew.bmp import encode_bmp24, encode_packed4
+from convnew.check import check_bmp
+from convnew.colorspace import srgb_to_lab, delta_e2000
+from convnew.dither import DIFFUSION_KERNELS
+from convnew.ordered import THRESHOLD_MAPS
+from convnew.lut import METRICS
+from convnew.palette import get_palette
+from convnew.main import (
+    PRESETS, build_config, get_palette_colors, get_match_colors, get_panel_codes, resize_image,
+    preprocess_image, optimize_colors, validate_colors, quantize_indices,
+)
+
+DEFAULT_SIZES = '800x480,480x800,1600x960'
+# ordered/knoll 可写成 方法:阈值图，例如 ordered:bluenoise
+METHODS = (list(DIFFUSION_KERNELS) + ['ordered', 'knoll', 'none']
+           + [f'{m}:{t}' for m in ('ordered', 'knoll') for t in THRESHOLD_MAPS])
+DEFAULT_METHODS = ['floyd', 'ordered', 'none']
+
+# 画质评估时模糊的半径：近似观看距离下抖动图案混合后的颜色
+QUALITY_BLUR_RADIUS = 1.5
+
+# 仓库自带的真实图片（存在时自动加入）
+REPO_FIXTURES = ['test_input.jpg']
+
+
+def gradient_fixture(width, height):
+    """渐变测试图（与 create_gradient_test.py 相同的布局：5段单色渐变 + 彩虹带）"""
+    img = np.full((height, width, 3), 255, dtype=np.uint8)
+    section = height // 6
+    ramp = (255 * np.arange(section) / max(section, 1)).astype(np.uint8)
+    for i, channels in enumerate([(0,), (1,), (2,), (0, 1), (0, 1, 2)]):
+        block = np.zeros((section, width, 3), dtype=np.uint8)
+        for c in channels:
+            block[:, :, c] = ramp[:, np.newaxis]
+        img[i * section:(i + 1) * section] = block
+
+    # 彩虹带：简单的 HSV 到 RGB 转换
+    hue = 6.0 * np.arange(width) / width
+    x = 1 - np.abs(hue % 2 - 1)
+    sector = hue.astype(int)
+    zero, one = np.zeros(width), np.ones(width)
+    rgb = np.select(
+        [sector[:, None] == k for k in range(6)],
+        [np.stack(v, axis=1) for v in [(one, x, zero), (x, one, zero), (zero, one, x),
+                                       (zero, x, one), (x, zero, one), (one, zero, x)]])
+    img[5 * section:] = (rgb * 255).astype(np.uint8)[np.newaxis]
+    return img
+
+
+def noise_fixture(width, height, seed=0):
+    """照片般的平滑噪声：低分辨率随机色块放大后叠加细噪声"""
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray(rng.integers(0, 256, (max(height // 40, 2), max(width // 40, 2), 3),
+                                          dtype=np.uint8))
+    smooth = np.asarray(coarse.resize((width, height), Image.Resampling.BICUBIC), dtype=np.float32)
+    return np.clip(smooth + rng.normal(0, 10, smooth.shape), 0, 255).astype(np.uint8)
+
+
+def blocks_fixture(width, height):
+    """纯色块测试图（与 test_optimized.py 相同：6个E6颜色块）"""
+    colors = get_palette_colors('e6').astype(np.uint8)
+    img = np.zeros((height, width, 3), dtype=np.uint8)
+    for i, color in enumerate(colors):
+        row, col = divmod(i, 3)
+        img[row * height // 2:(row + 1) * height // 2, col * width // 3:(col + 1) * width // 3] = color
+    return img
+
+
+SYNTHETIC_FIXTURES = {
+    'gradient': gradient_fixture,
+    'noise': noise_fixture,
+    'blocks': blocks_fixture,
+}
+
+
+def parse_sizes(text):
+    """解析 '800x480,1600x960' 形式的尺寸列表，格式无效时抛出 ValueError"""
+    sizes = []
+    for item in text.split(','):
+        try:
+            w, h = (int(v) for v in item.lower().split('x'))
+        except ValueError:
+            raise ValueError('--sizes 格式应为 WxH[,WxH…]') from None
+        if w < 1 or h < 1:
+            raise ValueError('--sizes 格式应为 WxH[,WxH…]')
+        sizes.append((w, h))
+    return sizes
+
+
+def load_fixtures(images, sizes):
+    """生成 (名称, 源图像) 列表；源图像为目标尺寸的2倍，以便测量缩放阶段"""
+    fixtures = []
+    for width, height in sizes:
+        for name, make in SYNTHETIC_FIXTURES.items():
+            source = Image.fromarray(make(width * 2, height * 2))
+            fixtures.append((f'{name}@{width}x{height}', source, (width, height)))
+        for path in images:
+            source = Image.open(path).convert('RGB')
+            label = os.path.splitext(os.path.basename(path))[0]
+            fixtures.append((f'{label}@{width}x{height}', source, (width, height)))
+    return fixtures
+
+
+def quantize(img_array, colors, method, metric='rgb', threads=1):
+    """按 bench 的方法名（可带 :阈值图）量化"""
+    method, _, threshold_map = method.partition(':')
+    return quantize_indices(img_array, colors, method, metric, threads=threads,
+                            threshold_map=threshold_map or 'bayer4')
+
+
+def palette_image(palette):
+    """pil_quantize 阶段使用的PIL调色板图像（E6 在第4项保留跳过位，与 create_e6_palette 相同）"""
+    palette = get_palette(palette)
+    entries = palette['output'].astype(np.uint8).tolist()
+    if palette['panel'] == 'e6':
+        entries.insert(4, [0, 0, 0])  # 跳过定义 (占位)
+    flat = [v for color in entries for v in color]
+    pal_img = Image.new('P', (1, 1))
+    pal_img.putpalette(flat + [0] * (768 - len(flat)))
+    return pal_img
+
+
+def pipeline_stages(source, size, palette, config, methods, metrics=('rgb',), threads=1):
+    """按流程顺序返回 [(阶段名, 无参函数)]；每个阶段的输入预先算好"""
+    width, height = size
+    colors = get_palette_colors(palette)
+    match = get_match_colors(palette)
+    codes = get_panel_codes(palette)
+
+    encoded = io.BytesIO()
+    source.save(encoded, 'PNG')
+    encoded = encoded.getvalue()
+
+    resized = resize_image(source.copy(), width, height, 'fit')
+    preprocessed = np.array(preprocess_image(resized, config), dtype=np.uint8)
+    indices = quantize_indices(preprocessed, match, 'floyd')
+    rgb = colors.astype(np.uint8)[indices]
+    pal_img = palette_image(palette)
+    bmp_data = encode_bmp24(indices, colors)
+
+    stages = [
+        ('open', lambda: Image.open(io.BytesIO(encoded)).convert('RGB')),
+        ('resize', lambda: resize_image(source.copy(), width, height, 'fit')),
+        ('preprocess', lambda: preprocess_image(resized, config)),
+        ('preprocess:pil', lambda: preprocess_image(resized, config, 'pil')),
+        ('optimize_colors', lambda: optimize_colors(preprocessed)),
+    ]
+    for method in methods:
+        for metric in metrics:
+            name = f'quantize:{method}' if metric == 'rgb' else f'quantize:{method}:{metric}'
+            stages.append((name, lambda m=method, d=metric: quantize(preprocessed, match, m, d)))
+        if threads > 1 and method in DIFFUSION_KERNELS:
+            stages.append((f'quantize:{method}:threads{threads}',
+                           lambda m=method: quantize(preprocessed, match, m, threads=threads)))
+    stages += [
+        ('validate', lambda: validate_colors(rgb, colors)),
+        ('pil_quantize', lambda: Image.fromarray(rgb).quantize(palette=pal_img).convert('RGB')),
+        ('save_bmp', lambda: encode_bmp24(indices, colors)),
+        ('save_packed', lambda: encode_packed4(indices, codes)),
+        ('save_preview', lambda: Image.fromarray(rgb).save(io.BytesIO(), 'PNG')),
+        ('check', lambda: check_bmp(bmp_data, colors)),
+    ]
+    return stages
+
+
+def measure(func, repeat):
+    """返回 (最短耗时毫秒, 峰值内存MB)"""
+    func()  # 预热：JIT编译、查找表加载等只在首次发生
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best * 1000, peak / (1 << 20)
+
+
+def run_bench(fixtures, palettes, config, methods, repeat, stage_filter=None, log=print,
+              metrics=('rgb',), threads=1):
+    """运行全部基准，返回 {键: {'ms': .., 'peak_mb': ..}}"""
+    results = {}
+    for name, source, size in fixtures:
+        for palette in palettes:
+            for stage, func in pipeline_stages(source, size, palette, config, methods, metrics,
+                                                     threads):
+                if stage_filter and not any(f in stage for f in stage_filter):
+                    continue
+                ms, peak = measure(func, repeat)
+                key = f'{name}/{get_palette(palette)["name"]}/{stage}'
+                results[key] = {'ms': round(ms, 3), 'peak_mb': round(peak, 2)}
+                log(f'{key:<48} {ms:10.2f} ms {peak:9.1f} MB')
+    return results
+
+
+def mean_delta_e(reference, result, blur=0):
+    """两幅 RGB 图像的平均 CIEDE2000 色差；blur > 0 时先对两者做高斯模糊"""
+    if blur:
+        reference = np.asarray(Image.fromarray(reference).filter(ImageFilter.GaussianBlur(blur)))
+        result = np.asarray(Image.fromarray(result).filter(ImageFilter.GaussianBlur(blur)))
+    return float(delta_e2000(srgb_to_lab(reference), srgb_to_lab(result)).mean())
+
+
+def run_quality(fixtures, palettes, config, methods, metrics, repeat, log=print):
+    """比较各距离度量的画质与速度，返回 {键: {'ms', 'peak_mb', 'delta_e', 'delta_e_blur'}}
+
+    delta_e 为逐像素的平均色差（无抖动时即匹配误差），delta_e_blur 为模糊后的
+    平均色差（抖动时更接近观看效果）。查找表在预热时生成，不计入耗时。
+    """
+    results = {}
+    for name, source, (width, height) in fixtures:
+        resized = resize_image(source.copy(), width, height, 'fit')
+        preprocessed = np.array(preprocess_image(resized, config), dtype=np.uint8)
+        for palette in palettes:
+            # 画质按面板实际显示的颜色（匹配颜色）评估
+            colors = get_match_colors(palette)
+            label = get_palette(palette)['name']
+            for method in methods:
+                for metric in metrics:
+                    func = lambda: quantize(preprocessed, colors, method, metric)
+                    ms, peak = measure(func, repeat)
+                    rgb = colors.astype(np.uint8)[func()]
+                    key = f'{name}/{label}/quality:{method}:{metric}'
+                    results[key] = {
+                        'ms': round(ms, 3), 'peak_mb': round(peak, 2),
+                        'delta_e': round(mean_delta_e(preprocessed, rgb), 3),
+                        'delta_e_blur': round(mean_delta_e(preprocessed, rgb, QUALITY_BLUR_RADIUS), 3),
+                    }
+                    log(f'{key:<48} {ms:10.2f} ms   ΔE00 {results[key]["delta_e"]:6.2f}'
+                        f' / {results[key]["delta_e_blur"]:6.2f}')
+    return results
+
+
+def compare(results, baseline, threshold):
+    """与基线比较，返回回退列表 [(键, 基线ms, 当前ms)]"""
+    regressions = []
+    for key, current in results.items():
+        base = baseline.get(key)
+        if base and current['ms'] > base['ms'] * (1 + threshold) and current['ms'] - base['ms'] > 0.5:
+            regressions.append((key, base['ms'], current['ms']))
+    return regressions
+
+
+def build_parser():
+    """构建 bench 子命令的参数解析器"""
+    parser = argparse.ArgumentParser(
+        prog='convnew bench',
+        description='转换流程各阶段的基准测试（ms/帧 与峰值内存）')
+    parser.add_argument('images', nargs='*', help='额外的真实图片（默认包含仓库中的 test_input.jpg）')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help=f'帧尺寸列表（默认: {DEFAULT_SIZES}）')
+    parser.add_argument('--palette', default='all',
+                        help='调色板：all（e6 和 e7）、内置调色板名称或 .json/.gpl 调色板文件')
+    parser.add_argument('--preset', choices=list(PRESETS), default='photo', help='预处理预设')
+    parser.add_argument('--method', action='append', choices=METHODS,
+                        help=f'只测试指定的量化方法（可重复，默认: {", ".join(DEFAULT_METHODS)}）')
+    parser.add_argument('--metric', action='append', choices=list(METRICS),
+                        help='量化阶段使用的颜色距离度量（可重复，默认 rgb；--quality 时默认全部）')
+    parser.add_argument('--dither-threads', type=int, default=1, metavar='N',
+                        help='大于1时为误差扩散方法增加 N 线程并行处理的阶段')
+    parser.add_argument('--quality', action='store_true',
+                        help='比较各距离度量的画质（平均 CIEDE2000 色差，逐像素 / 模糊后）与速度')
+    parser.add_argument('--stage', action='append',
+                        help='只运行名称包含该字符串的阶段（可重复）')
+    parser.add_argument('--repeat', type=int, default=3, help='每个阶段的计时次数（取最短）')
+    parser.add_argument('--no-synthetic', action='store_true', help='不使用合成图像')
+    parser.add_argument('--save', metavar='JSON', help='把结果保存为基线JSON')
+    parser.add_argument('--baseline', metavar='JSON', help='与之前保存的基线比较')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='判定为回退的相对变慢比例（默认 0.2 即 20%%）')
+    return parser
+
+
+def main(argv=None):
+    """bench 子命令入口，发现回退时返回 1"""
+    args = build_parser().parse_args(argv)
+    palettes = ['e6', 'e7'] if args.palette == 'all' else [args.palette]
+    try:
+        sizes = parse_sizes(args.sizes)
+        for palette in palettes:
+            get_palette(palette)
+    except ValueError as e:
+        print(f'错误：{e}')
+        return 1
+    images = list(args.images)
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name in REPO_FIXTURES:
+        path = os.path.join(repo_root, name)
+        if os.path.isfile(path) and not images:
+            images.append(path)
+
+    fixtures = load_fixtures(images, sizes)
+    if args.no_synthetic:
+        fixtures = [f for f in fixtures if f[0].split('@')[0] not in SYNTHETIC_FIXTURES]
+
+    print(f'convnew {__version__}, Python {platform.python_version()}, NumPy {np.__version__}')
+    if args.quality:
+        print(f'{"度量":<46} {"耗时":>13}   {"ΔE00 逐像素 / 模糊后":>20}')
+        print('-' * 86)
+        results = run_quality(fixtures, palettes, build_config(args.preset),
+                              args.method or DEFAULT_METHODS, args.metric or list(METRICS),
+                              args.repeat)
+    else:
+        print(f'{"阶段":<46} {"耗时":>13} {"峰值内存":>10}')
+        print('-' * 76)
+        results = run_bench(fixtures, palettes, build_config(args.preset),
+                            args.method or DEFAULT_METHODS, args.repeat, args.stage,
+                            metrics=args.metric or ['rgb'], threads=args.dither_threads)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'version': __version__, 'python': platform.python_version(),
+                       'results': results}, f, ensure_ascii=False, indent=2)
+        print(f'\n结果已保存: {args.save}')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        print('\n' + '=' * 76)
+        if regressions:
+            print(f'✗ 发现 {len(regressions)} 个性能回退（阈值 {args.threshold:.0%}）:')
+            for key, before, after in regressions:
+                print(f'  {key}: {before:.2f} ms → {after:.2f} ms ({after / before:.2f}x)')
+            return 1
+        print(f'✓ 与基线相比没有性能回退（阈值 {args.threshold:.0%}）')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
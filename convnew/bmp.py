@@ -0,0 +1,131 @@
+#encoding: utf-8
+"""直接从调色板索引平面生成固件文件
+
+固件（backup/GUI_BMPfile.c）读取24位BMP，并逐像素比较RGB值。
+这里把 (H, W) 的调色板索引平面一次查表为BGR字节，写出与PIL保存结果
+字节完全一致的文件，省去 fromarray / quantize / convert 的整帧往返。
+另外提供体积约为1/6的4bpp打包格式及其解码器。
+"""
+
+import os
+import struct
+
+import numpy as np
+
+# PIL 默认的 96 DPI，换算为每米像素数
+BMP_PPM = int(96 * 39.3701 + 0.5)
+
+BMP_HEADER_SIZE = 14 + 40
+
+
+def encode_bmp24(indices, colors):
+    """把调色板索引平面编码为24位BMP字节串"""
+    indices = np.asarray(indices, dtype=np.uint8)
+    height, width = indices.shape
+    stride = (width * 3 + 3) & ~3
+    image_size = stride * height
+
+    header = struct.pack('<2sIHHI', b'BM', BMP_HEADER_SIZE + image_size, 0, 0, BMP_HEADER_SIZE)
+    header += struct.pack('<IiiHHIIiiII', 40, width, height, 1, 24, 0,
+                          image_size, BMP_PPM, BMP_PPM, 0, 0)
+
+    # 每个索引对应的BGR字节；BMP行序自下而上
+    bgr = np.ascontiguousarray(np.asarray(colors).astype(np.uint8)[:, ::-1])
+    rows = np.zeros((height, stride), dtype=np.uint8)
+    rows[:, :width * 3] = bgr[indices[::-1]].reshape(height, width * 3)
+    return header + rows.tobytes()
+
+
+# 4bpp 打包格式：每字节两个像素（高4位在前），值为固件颜色编码
+# （即 backup/GUI_BMPfile*.c 中 Paint_SetPixel 使用的 color 值）。
+# 像素顺序与24位BMP相同：自下而上逐行、每行从左到右，固件可以保留原有的
+# 坐标映射，只把每像素3字节读取+比较换成一次半字节提取。
+# 可选的16字节文件头：魔数、版本、颜色数、宽、高（小端）。
+PACKED_MAGIC = b'CNP4'
+PACKED_VERSION = 1
+PACKED_HEADER = struct.Struct('<4sBBHH6x')
+
+
+def encode_packed4(indices, codes, header=True):
+    """把调色板索引平面编码为4bpp打包数据（codes: 调色板索引 → 固件颜色编码）"""
+    indices = np.asarray(indices, dtype=np.uint8)
+    height, width = indices.shape
+    plane = np.asarray(codes, dtype=np.uint8)[indices[::-1]]
+    if width % 2:
+        # 奇数宽度时每行末尾补一个半字节，保证行按字节对齐
+        plane = np.pad(plane, ((0, 0), (0, 1)))
+    data = (plane[:, 0::2] << 4 | plane[:, 1::2]).tobytes()
+    if not header:
+        return data
+    return PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, len(codes), width, height) + data
+
+
+def decode_packed4(data, width=None, height=None):
+    """解析4bpp打包数据，返回 (固件颜色编码平面, 颜色数)
+
+    带文件头时尺寸和颜色数取自文件头；无文件头时需给出 width/height，
+    否则按单行返回全部半字节（颜色数为 None）。返回的平面按显示方向自上而下。
+    """
+    data = bytes(data)
+    ncolors = None
+    if data[:4] == PACKED_MAGIC:
+        magic, version, ncolors, width, height = PACKED_HEADER.unpack_from(data)
+        if version != PACKED_VERSION:
+            raise ValueError(f'不支持的打包格式版本: {version}')
+        data = data[PACKED_HEADER.size:]
+
+    packed = np.frombuffer(data, dtype=np.uint8)
+    if width is None or height is None:
+        width, height = packed.size * 2, 1
+    row_bytes = (width + 1) // 2
+    if packed.size != row_bytes * height:
+        raise ValueError(f'数据长度 {packed.size} 与尺寸 {width}x{height} 不符')
+
+    packed = packed.reshape(height, row_bytes)
+    plane = np.empty((height, row_bytes * 2), dtype=np.uint8)
+    plane[:, 0::2] = packed >> 4
+    plane[:, 1::2] = packed & 0x0F
+    return plane[::-1, :width], ncolors
+
+
+BMP_INFO = struct.Struct('<2sIHHIIiiHHI')
+
+
+def read_bmp_info(header):
+    """解析BMP文件头，返回 (像素数据偏移, 宽, 高, 位深, 压缩方式, 行是否自上而下)"""
+    if len(header) < BMP_INFO.size:
+        raise ValueError('文件太短，不是有效的BMP')
+    magic, _, _, _, offset, _, width, height, _, bits, compression = BMP_INFO.unpack_from(header)
+    if magic != b'BM':
+        raise ValueError('不是BMP文件')
+    return offset, width, abs(height), bits, compression, height < 0
+
+
+def open_bmp24_rows(source):
+    """以 (H, stride) uint8 数组访问24位BMP的像素行，不解码整幅图像
+
+    source 为路径时使用内存映射（只读取实际访问的行），也可以是字节串或文件对象。
+    返回 (rows, 宽, 高, 行是否自上而下)；rows 按文件中的存储顺序排列。
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            header = f.read(BMP_INFO.size)
+        buffer = None
+    else:
+        data = source if isinstance(source, (bytes, bytearray, memoryview)) else source.read()
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        header = bytes(buffer[:BMP_INFO.size])
+
+    offset, width, height, bits, compression, top_down = read_bmp_info(header)
+    if bits != 24 or compression != 0:
+        raise ValueError(f'不是24位未压缩BMP（位深{bits}，压缩方式{compression}）')
+    stride = (width * 3 + 3) & ~3
+    size = os.path.getsize(source) if buffer is None else buffer.size
+    if size < offset + stride * height:
+        raise ValueError('BMP文件被截断')
+
+    if buffer is None:
+        rows = np.memmap(source, dtype=np.uint8, mode='r', offset=offset, shape=(height, stride))
+    else:
+        rows = buffer[offset:offset + stride * height].reshape(height, stride)
+    return rows, width, height, top_down
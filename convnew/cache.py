@@ -0,0 +1,105 @@
+#encoding: utf-8
+"""按内容寻址的转换结果缓存
+
+键由输入文件字节的哈希和实际生效的转换设置（预设参数、抖动方法、调色板、
+方向、缩放模式、转换器版本）组成，值为转换得到的调色板索引平面，
+以4bpp打包格式保存（800x480 约 190 KB）。输出格式无关：命中后只需重新
+编码和写出文件，跳过解码、缩放、预处理和抖动。
+缓存总大小超过上限时按最近使用时间（文件修改时间）淘汰最旧的条目。
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from convnew.bmp import encode_packed4, decode_packed4
+from convnew.lut import default_cache_dir
+
+# 缓存条目格式变化时递增，使旧条目失效
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_SIZE = 1 << 30  # 1 GB
+
+ENTRY_SUFFIX = '.cnp4'
+
+
+def results_dir(cache_dir=None):
+    """转换结果缓存目录（与查找表共用缓存根目录）"""
+    return os.path.join(cache_dir or default_cache_dir(), 'results')
+
+
+def cache_key(data, settings):
+    """输入字节 + 转换设置的键；settings 必须可以序列化为JSON"""
+    digest = hashlib.sha256(data)
+    digest.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    digest.update(f'v{CACHE_VERSION}'.encode('ascii'))
+    return digest.hexdigest()
+
+
+def _entry_path(key, cache_dir):
+    return os.path.join(results_dir(cache_dir), key[:2], key + ENTRY_SUFFIX)
+
+
+def load_result(key, cache_dir=None):
+    """读取缓存的索引平面，未命中或条目损坏时返回 None"""
+    path = _entry_path(key, cache_dir)
+    try:
+        with open(path, 'rb') as f:
+            plane, _ = decode_packed4(f.read())
+        os.utime(path)  # 更新最近使用时间，供 LRU 淘汰
+    except (OSError, ValueError):
+        return None
+    return np.ascontiguousarray(plane)
+
+
+def store_result(key, indices, cache_dir=None):
+    """保存索引平面（原子写入）；淘汰由调用方在批处理结束后统一调用 evict()"""
+    path = _entry_path(key, cache_dir)
+    # 以恒等编码表打包，解码得到的就是调色板索引
+    data = encode_packed4(indices, np.arange(int(indices.max(initial=0)) + 1))
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+    except OSError:
+        return False  # 缓存目录不可写时不缓存
+    return True
+
+
+def evict(cache_dir=None, max_size=DEFAULT_CACHE_SIZE):
+    """按最近使用时间从旧到新删除条目，直到总大小不超过 max_size；返回删除的条目数"""
+    entries = []
+    total = 0
+    for root, _, files in os.walk(results_dir(cache_dir)):
+        for name in files:
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:  # 被其他进程同时删除
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+    removed = 0
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+        total -= size
+    return removed
@@ -0,0 +1,144 @@
+#encoding: utf-8
+"""批量固件兼容性检查
+
+逐块读取内存映射的BMP像素行，用按调色板缓存的 2^24 布尔查找表判断
+每个像素是否为有效颜色，整幅图像不会一次性载入内存。支持文件、目录
+（递归）和通配符输入，使用进程池并行检查，并生成可序列化为JSON的汇总。
+"""
+
+import glob
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from convnew.bmp import open_bmp24_rows, decode_packed4
+
+# 每次检查的行数
+DEFAULT_CHUNK_ROWS = 64
+
+# 每个文件最多记录的无效像素样本数
+MAX_SAMPLES = 10
+
+# 进程内缓存的有效颜色查找表：{调色板字节: lut}
+_valid_luts = {}
+
+
+def valid_color_lut(colors):
+    """有效颜色查找表：lut[(r << 16) | (g << 8) | b] 为 True 表示是调色板颜色"""
+    palette = np.asarray(colors).astype(np.uint8)
+    key = palette.tobytes()
+    lut = _valid_luts.get(key)
+    if lut is None:
+        lut = np.zeros(1 << 24, dtype=bool)
+        packed = (palette[:, 0].astype(np.uint32) << 16 |
+                  palette[:, 1].astype(np.uint32) << 8 | palette[:, 2])
+        lut[packed] = True
+        _valid_luts[key] = lut
+    return lut
+
+
+def check_bmp(source, colors, chunk_rows=DEFAULT_CHUNK_ROWS, max_samples=MAX_SAMPLES):
+    """检查24位BMP，返回结果字典
+
+    结果包含 total_pixels、bad_pixels 以及最多 max_samples 个无效像素样本
+    [x, y, r, g, b]（y 为从上往下的显示坐标）。
+    """
+    rows, width, height, top_down = open_bmp24_rows(source)
+    lut = valid_color_lut(colors)
+    bad_pixels = 0
+    samples = []
+
+    # 按显示顺序（自上而下）逐块检查，样本坐标与图像坐标一致
+    for y0 in range(0, height, chunk_rows):
+        y1 = min(y0 + chunk_rows, height)
+        if top_down:
+            block = rows[y0:y1]
+        else:
+            block = rows[height - y1:height - y0][::-1]
+        block = np.asarray(block[:, :width * 3]).reshape(-1, width, 3)
+        # 文件中为BGR顺序
+        keys = (block[:, :, 2].astype(np.uint32) << 16 |
+                block[:, :, 1].astype(np.uint32) << 8 | block[:, :, 0])
+        invalid = ~lut[keys]
+        count = int(np.count_nonzero(invalid))
+        if not count:
+            continue
+        bad_pixels += count
+        if len(samples) < max_samples:
+            for row, x in zip(*np.nonzero(invalid)):
+                b, g, r = block[row, x].tolist()
+                samples.append([int(x), y0 + int(row), r, g, b])
+                if len(samples) >= max_samples:
+                    break
+
+    return {'total_pixels': width * height, 'bad_pixels': bad_pixels, 'samples': samples}
+
+
+def check_packed(source, codes, max_samples=MAX_SAMPLES):
+    """检查4bpp打包文件，返回与 check_bmp 相同结构的结果字典"""
+    if hasattr(source, 'read'):
+        data = source.read()
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+    plane, ncolors = decode_packed4(data)
+    if ncolors is not None and ncolors != len(codes):
+        raise ValueError(f'文件为{ncolors}色，目标调色板为{len(codes)}色')
+
+    invalid = ~np.isin(plane, codes)
+    samples = [[int(x), int(y), int(plane[y, x])]
+               for y, x in zip(*np.nonzero(invalid))][:max_samples]
+    return {'total_pixels': int(plane.size), 'bad_pixels': int(np.count_nonzero(invalid)),
+            'samples': samples}
+
+
+def check_file(path, colors, codes):
+    """按扩展名检查单个文件；读取失败也作为不兼容记录，而不是抛出异常"""
+    result = {'path': path}
+    try:
+        if path.lower().endswith('.bin'):
+            result.update(check_packed(path, codes))
+        else:
+            result.update(check_bmp(path, colors))
+        result['error'] = None
+    except Exception as e:
+        result.update(total_pixels=0, bad_pixels=0, samples=[], error=str(e))
+    result['ok'] = result['error'] is None and result['bad_pixels'] == 0
+    return result
+
+
+def collect_check_paths(pattern):
+    """展开检查目标：文件、目录（递归查找 .bmp/.bin）或通配符"""
+    if os.path.isdir(pattern):
+        paths = []
+        for root, _, files in os.walk(pattern):
+            paths.extend(os.path.join(root, name) for name in files
+                         if name.lower().endswith(('.bmp', '.bin')))
+        return sorted(paths)
+    if os.path.isfile(pattern):
+        return [pattern]
+    return sorted(p for p in glob.glob(pattern, recursive=True) if os.path.isfile(p))
+
+
+def check_many(paths, colors, codes, jobs=1):
+    """并行检查多个文件，返回汇总字典（可直接 json.dump）"""
+    start = time.perf_counter()
+    if jobs > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(paths))) as executor:
+            chunksize = max(1, len(paths) // (jobs * 8))
+            results = list(executor.map(check_file, paths, itertools.repeat(colors),
+                                        itertools.repeat(codes), chunksize=chunksize))
+    else:
+        results = [check_file(path, colors, codes) for path in paths]
+
+    failures = [r for r in results if not r['ok']]
+    return {
+        'checked': len(results),
+        'passed': len(results) - len(failures),
+        'failed': len(failures),
+        'seconds': round(time.perf_counter() - start, 3),
+        'failures': [{k: v for k, v in r.items() if k != 'ok'} for r in failures],
+    }
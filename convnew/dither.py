@@ -0,0 +1,318 @@
+#encoding: utf-8
+"""误差扩散抖动引擎
+
+任意误差扩散核共用同一个内核（DIFFUSION_KERNELS 中为常用的核）。优先使用 numba
+编译内核；未安装 numba 时回退到按反对角线（wavefront）向量化的 NumPy 实现。
+两种实现与原先逐像素的 Python 版本输出逐像素一致。
+"""
+
+import sys
+import numpy as np
+
+from convnew.lut import get_lut
+from convnew.quantize import nearest_color_indices
+
+try:
+    from numba import njit, prange
+    import numba
+    HAVE_NUMBA = True
+except ImportError:  # numba 为可选依赖
+    njit = None
+    prange = range
+    HAVE_NUMBA = False
+
+# 并行误差扩散时每个任务处理的一段行内像素数
+PARALLEL_BLOCK = 32
+
+# 已准备好的内核参数与调色板数组（见 _prepare）
+_prepared = {}
+
+
+def make_kernel(matrix, divisor):
+    """由误差扩散矩阵构造 (偏移, 系数)
+
+    matrix 的第一行是当前行，当前像素位于中间列；当前像素及其左侧的项必须为0。
+    偏移按行优先顺序排列，即误差的分配顺序。
+    """
+    matrix = np.asarray(matrix)
+    center = matrix.shape[1] // 2
+    if np.any(matrix[0, :center + 1]):
+        raise ValueError('误差扩散核不能向当前行左侧或自身分配误差')
+    ys, xs = np.nonzero(matrix)
+    offsets = np.stack([xs - center, ys], axis=1).astype(np.int64)
+    weights = np.array([matrix[y, x] / divisor for y, x in zip(ys, xs)], dtype=np.float64)
+    return offsets, weights
+
+
+# Floyd-Steinberg 误差分配：(dx, dy) 偏移与对应系数，顺序即分配顺序
+FLOYD_STEINBERG = make_kernel([[0, 0, 7],
+                               [3, 5, 1]], 16)
+
+# 可用的误差扩散核（--method 的名称 → 核）
+DIFFUSION_KERNELS = {
+    'floyd': FLOYD_STEINBERG,
+    # Atkinson：只扩散 3/4 的误差，对比度更高、暗部更干净
+    'atkinson': make_kernel([[0, 0, 0, 1, 1],
+                             [0, 1, 1, 1, 0],
+                             [0, 0, 1, 0, 0]], 8),
+    'jjn': make_kernel([[0, 0, 0, 7, 5],
+                        [3, 5, 7, 5, 3],
+                        [1, 3, 5, 3, 1]], 48),
+    'stucki': make_kernel([[0, 0, 0, 8, 4],
+                           [2, 4, 8, 4, 2],
+                           [1, 2, 4, 2, 1]], 42),
+    'burkes': make_kernel([[0, 0, 0, 8, 4],
+                           [2, 4, 8, 4, 2]], 32),
+    'sierra': make_kernel([[0, 0, 0, 5, 3],
+                           [2, 4, 5, 4, 2],
+                           [0, 2, 3, 2, 0]], 32),
+    'sierra2': make_kernel([[0, 0, 0, 4, 3],
+                            [1, 2, 3, 2, 1]], 16),
+    'sierra-lite': make_kernel([[0, 0, 2],
+                                [1, 1, 0]], 4),
+}
+
+
+def _diffuse_python(img, colors, targets, offsets, weights, indices, lut, use_lut, serpentine):
+    """逐像素误差扩散内核（img为float64，原地修改；写入调色板索引）
+
+    use_lut 为真时，按四舍五入后的像素值在查找表 lut 中取最近颜色（感知色差度量），
+    否则直接计算 RGB 平方距离。serpentine 为真时奇数行从右向左扫描，核随之左右镜像。
+    """
+    height, width = img.shape[0], img.shape[1]
+    ncolors = colors.shape[0]
+    nweights = weights.shape[0]
+    for y in range(height):
+        step = -1 if serpentine and y % 2 == 1 else 1
+        start = width - 1 if step < 0 else 0
+        for i in range(width):
+            x = start + i * step
+            r = min(max(img[y, x, 0], 0.0), 255.0)
+            g = min(max(img[y, x, 1], 0.0), 255.0)
+            b = min(max(img[y, x, 2], 0.0), 255.0)
+
+            if use_lut:
+                best = int(lut[int(r + 0.5), int(g + 0.5), int(b + 0.5)])
+            else:
+                # 与 find_nearest_color 相同：在float32下计算平方距离，取第一个最小值
+                pr, pg, pb = np.float32(r), np.float32(g), np.float32(b)
+                best = 0
+                best_dist = np.float32(np.inf)
+                for k in range(ncolors):
+                    dr = colors[k, 0] - pr
+                    dg = colors[k, 1] - pg
+                    db = colors[k, 2] - pb
+                    dist = dr * dr + dg * dg + db * db
+                    if dist < best_dist:
+                        best_dist = dist
+                        best = k
+            indices[y, x] = best
+
+            nr, ng, nb = targets[best, 0], targets[best, 1], targets[best, 2]
+            img[y, x, 0] = nr
+            img[y, x, 1] = ng
+            img[y, x, 2] = nb
+            er, eg, eb = r - nr, g - ng, b - nb
+
+            # 分配误差到周围像素（每次累加后立即截断，与原实现一致）
+            for j in range(nweights):
+                nx = x + offsets[j, 0] * step
+                ny = y + offsets[j, 1]
+                if 0 <= nx < width and 0 <= ny < height:
+                    w = weights[j]
+                    img[ny, nx, 0] = min(max(img[ny, nx, 0] + er * w, 0.0), 255.0)
+                    img[ny, nx, 1] = min(max(img[ny, nx, 1] + eg * w, 0.0), 255.0)
+                    img[ny, nx, 2] = min(max(img[ny, nx, 2] + eb * w, 0.0), 255.0)
+
+
+def _diffuse_parallel_python(img, colors, targets, offsets, weights, indices, lut, use_lut,
+                             error, order, lag, block):
+    """按块的反对角线并行误差扩散（输出与逐行扫描逐像素一致）
+
+    每行分为宽 block 的像素块，块 (bx, y) 在第 bx + lag*y 步处理，同一步的块互不依赖，
+    并行执行。与逐行扫描的"分配"不同，每个像素在处理时按来源的扫描顺序（order）
+    "收集"来源像素保存在 error 中的误差，因此对每个像素的累加和截断顺序与逐行扫描
+    完全相同，且并行任务之间没有写冲突。img 只读。
+    """
+    height, width = img.shape[0], img.shape[1]
+    ncolors = colors.shape[0]
+    nblocks = (width + block - 1) // block
+    for t in range(nblocks + lag * (height - 1)):
+        y_lo = max(0, -(-(t - nblocks + 1) // lag))
+        y_hi = min(height - 1, t // lag)
+        for i in prange(y_hi - y_lo + 1):
+            y = y_lo + i
+            x0 = (t - lag * y) * block
+            for x in range(x0, min(x0 + block, width)):
+                r, g, b = img[y, x, 0], img[y, x, 1], img[y, x, 2]
+                for k in range(order.shape[0]):
+                    j = order[k]
+                    sx = x - offsets[j, 0]
+                    sy = y - offsets[j, 1]
+                    if 0 <= sx < width and sy >= 0:
+                        w = weights[j]
+                        r = min(max(r + error[sy, sx, 0] * w, 0.0), 255.0)
+                        g = min(max(g + error[sy, sx, 1] * w, 0.0), 255.0)
+                        b = min(max(b + error[sy, sx, 2] * w, 0.0), 255.0)
+                r = min(max(r, 0.0), 255.0)
+                g = min(max(g, 0.0), 255.0)
+                b = min(max(b, 0.0), 255.0)
+
+                if use_lut:
+                    best = int(lut[int(r + 0.5), int(g + 0.5), int(b + 0.5)])
+                else:
+                    # 与 find_nearest_color 相同：在float32下计算平方距离，取第一个最小值
+                    pr, pg, pb = np.float32(r), np.float32(g), np.float32(b)
+                    best = 0
+                    best_dist = np.float32(np.inf)
+                    for k in range(ncolors):
+                        dr = colors[k, 0] - pr
+                        dg = colors[k, 1] - pg
+                        db = colors[k, 2] - pb
+                        dist = dr * dr + dg * dg + db * db
+                        if dist < best_dist:
+                            best_dist = dist
+                            best = k
+                indices[y, x] = best
+                error[y, x, 0] = r - targets[best, 0]
+                error[y, x, 1] = g - targets[best, 1]
+                error[y, x, 2] = b - targets[best, 2]
+
+
+if HAVE_NUMBA:
+    # 打包后的可执行文件没有可写的缓存位置，此时不启用磁盘缓存
+    _diffuse_compiled = njit(cache=not getattr(sys, 'frozen', False),
+                             nogil=True)(_diffuse_python)
+    _diffuse_parallel = njit(cache=not getattr(sys, 'frozen', False),
+                             nogil=True, parallel=True)(_diffuse_parallel_python)
+else:
+    _diffuse_compiled = None
+    _diffuse_parallel = None
+
+
+def wavefront_lag(offsets):
+    """计算反对角线调度的行间延迟 L：像素(x, y)在第 x + L*y 步处理
+
+    L 需保证：所有误差来源都在目标像素之前处理，且对同一目标像素的
+    误差累加顺序与逐行扫描完全相同（同一步内的冲突按来源行从上到下处理）。
+    """
+    lag = 1
+    for dx, dy in offsets:
+        if dy == 0 and dx <= 0:
+            raise ValueError('误差扩散核不能向当前行左侧或自身分配误差')
+        if dy > 0:
+            lag = max(lag, -dx // dy + 1)
+    for dx1, dy1 in offsets:
+        for dx2, dy2 in offsets:
+            if dy1 > dy2:
+                lag = max(lag, -(-(dx2 - dx1) // (dy1 - dy2)))
+    return int(lag)
+
+
+def block_lag(offsets, block):
+    """并行调度的块间延迟：块 (bx, y) 在第 bx + lag*y 步处理，保证误差来源所在的块
+    都在更早的步中处理（同一块内按从左到右的顺序处理）
+    """
+    lag = 1
+    for dx, dy in offsets:
+        if dy > 0:
+            # 来源像素 x - dx 所在块相对目标块的偏移
+            for source_block in ((-dx) // block, -(dx // block)):
+                lag = max(lag, source_block // dy + 1)
+    return int(lag)
+
+
+def _diffuse_numpy(img, colors, targets, offsets, weights, indices, lut, use_lut):
+    """NumPy回退实现：沿反对角线批量处理互不依赖的像素"""
+    height, width = img.shape[:2]
+    lag = wavefront_lag(offsets)
+    # 同一步内来源行靠上的先分配（dy大者先），保持与逐行扫描相同的累加顺序
+    order = np.argsort(-offsets[:, 1], kind='stable')
+    all_rows = np.arange(height)
+
+    for t in range(width + lag * (height - 1)):
+        y_lo = max(0, -(-(t - width + 1) // lag))
+        y_hi = min(height - 1, t // lag)
+        ys = all_rows[y_lo:y_hi + 1]
+        xs = t - lag * ys
+
+        old = np.clip(img[ys, xs], 0, 255)
+        if use_lut:
+            rounded = np.floor(old + 0.5).astype(np.intp)
+            idx = lut[rounded[:, 0], rounded[:, 1], rounded[:, 2]]
+        else:
+            idx = nearest_color_indices(old, colors)
+        indices[ys, xs] = idx
+        new = targets[idx]
+        img[ys, xs] = new
+        error = old - new
+
+        for j in order:
+            dx, dy = offsets[j]
+            nx, ny = xs + dx, ys + dy
+            valid = (nx >= 0) & (nx < width) & (ny < height)
+            if not valid.all():
+                nx, ny, err = nx[valid], ny[valid], error[valid]
+            else:
+                err = error
+            img[ny, nx] = np.clip(img[ny, nx] + err * weights[j], 0, 255)
+
+
+def _prepare(kernel, colors, metric):
+    """内核参数、调色板数组和查找表，按 (误差扩散核, 调色板, 度量) 缓存"""
+    offsets, weights = kernel
+    offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+    weights = np.ascontiguousarray(weights, dtype=np.float64)
+    colors = np.ascontiguousarray(colors, dtype=np.float32)
+    key = (offsets.tobytes(), weights.tobytes(), colors.tobytes(), metric)
+    prepared = _prepared.get(key)
+    if prepared is None:
+        # 写回的像素值与 find_nearest_color 相同：调色板颜色转为uint8
+        targets = colors.astype(np.uint8).astype(np.float64)
+        lut = get_lut(colors, metric) if metric != 'rgb' else np.zeros((1, 1, 1), dtype=np.uint8)
+        prepared = _prepared[key] = (offsets, weights, colors, targets, lut)
+    return prepared
+
+
+def diffuse_indices(img_array, colors, kernel=FLOYD_STEINBERG, engine=None, metric='rgb',
+                    serpentine=False, threads=1):
+    """误差扩散抖动，返回(H, W) uint8调色板索引平面
+
+    kernel: (偏移, 系数)，见 make_kernel 和 DIFFUSION_KERNELS
+    engine: None 自动选择；'numba' 编译内核；'numpy' 向量化回退实现
+    metric: 颜色距离度量（见 convnew.lut.METRICS）；'rgb' 以外的度量使用预先计算的
+    查找表，速度与 'rgb' 相同
+    serpentine: 蛇形扫描（奇数行从右向左），可减少误差沿同一方向累积形成的纹理。
+    蛇形扫描的行间依赖无法按反对角线并行，'numpy' 引擎此时逐像素执行，速度很慢
+    threads: 大于1时 'numba' 引擎用这么多线程并行处理（不能与蛇形扫描同时使用，
+    此时按单线程处理）；输出与单线程逐像素一致
+    """
+    if engine is None:
+        engine = 'numba' if HAVE_NUMBA else 'numpy'
+    if engine == 'numba' and not HAVE_NUMBA:
+        raise RuntimeError('未安装 numba，无法使用编译内核')
+
+    offsets, weights, colors, targets, lut = _prepare(kernel, colors, metric)
+    use_lut = metric != 'rgb'
+
+    img = np.array(img_array, dtype=np.float64, order='C')
+    indices = np.zeros(img.shape[:2], dtype=np.uint8)
+
+    if engine == 'numba' and threads > 1 and not serpentine:
+        # 按来源的扫描顺序收集误差：来源行靠上的在前，同一行中靠左的在前
+        order = np.lexsort((-offsets[:, 0], -offsets[:, 1])).astype(np.int64)
+        error = np.empty_like(img)
+        previous = numba.get_num_threads()
+        numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+        try:
+            _diffuse_parallel(img, colors, targets, offsets, weights, indices, lut, use_lut,
+                              error, order, block_lag(offsets, PARALLEL_BLOCK), PARALLEL_BLOCK)
+        finally:
+            numba.set_num_threads(previous)
+    elif engine == 'numba':
+        _diffuse_compiled(img, colors, targets, offsets, weights, indices, lut, use_lut, serpentine)
+    elif serpentine:
+        _diffuse_python(img, colors, targets, offsets, weights, indices, lut, use_lut, True)
+    else:
+        _diffuse_numpy(img, colors, targets, offsets, weights, indices, lut, use_lut)
+    return indices
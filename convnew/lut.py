@@ -0,0 +1,127 @@
+#encoding: utf-8
+"""RGB → 调色板索引的预计算查找表（LUT）
+
+E6/E7 调色板是固定的，因此对 8 位 RGB 输入，最近颜色匹配可以预先算好：
+完整的 256³ 表（16 MB，uint8），按 调色板 + 距离度量 生成键，保存到缓存目录，
+之后通过 mmap 加载，匹配就变成一次花式索引（fancy indexing）。
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from convnew.quantize import (
+    nearest_color_indices, weighted_color_indices, lab_color_indices, ciede2000_color_indices,
+)
+
+# 表格式变化时递增，使旧缓存失效
+LUT_VERSION = 1
+
+# 距离度量：函数签名为 (pixels(N, 3), colors(K, 3)) -> uint8 索引
+METRICS = {
+    'rgb': nearest_color_indices,
+    'weighted': weighted_color_indices,
+    'lab': lab_color_indices,
+    'ciede2000': ciede2000_color_indices,
+}
+
+# 进程内已加载的表：{(度量, 调色板哈希): lut}
+_loaded = {}
+# 加载或生成表时持有，多个线程同时首次使用同一张表时只生成一次
+_load_lock = threading.Lock()
+
+
+def default_cache_dir():
+    """缓存目录：CONVNEW_CACHE_DIR > XDG_CACHE_HOME/LOCALAPPDATA > ~/.cache"""
+    path = os.environ.get('CONVNEW_CACHE_DIR')
+    if path:
+        return path
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'convnew')
+
+
+def palette_key(colors, metric='rgb'):
+    """调色板 + 度量的缓存键"""
+    colors = np.ascontiguousarray(colors, dtype=np.float32)
+    digest = hashlib.sha1(colors.tobytes() + repr(colors.shape).encode()).hexdigest()[:16]
+    return f'{metric}-{digest}-v{LUT_VERSION}'
+
+
+def build_lut(colors, metric='rgb'):
+    """计算完整的 256³ 查找表，lut[r, g, b] 为最近的调色板索引"""
+    if metric not in METRICS:
+        raise ValueError(f'未知的距离度量: {metric}')
+    nearest = METRICS[metric]
+    lut = np.empty((256, 256, 256), dtype=np.uint8)
+    gb = np.indices((256, 256), dtype=np.uint8).reshape(2, -1).T
+    plane = np.empty((gb.shape[0], 3), dtype=np.uint8)
+    plane[:, 1:] = gb
+    # 每次处理一个 r 平面（65536 个颜色），内存占用恒定
+    for r in range(256):
+        plane[:, 0] = r
+        lut[r] = nearest(plane, colors).reshape(256, 256)
+    return lut
+
+
+def get_lut(colors, metric='rgb', cache_dir=None):
+    """获取查找表：进程内缓存 → 磁盘缓存(mmap) → 重新计算并写入磁盘"""
+    key = palette_key(colors, metric)
+    lut = _loaded.get(key)
+    if lut is not None:
+        return lut
+    with _load_lock:
+        lut = _loaded.get(key)
+        if lut is None:
+            lut = _load_or_build(key, colors, metric, cache_dir)
+            _loaded[key] = lut
+    return lut
+
+
+def _load_or_build(key, colors, metric, cache_dir):
+    """从磁盘缓存加载表，不存在或无效时重新计算并写入磁盘"""
+    cache_dir = cache_dir or default_cache_dir()
+    path = os.path.join(cache_dir, f'lut-{key}.npy')
+    try:
+        lut = np.load(path, mmap_mode='r')
+        if lut.shape != (256, 256, 256) or lut.dtype != np.uint8:
+            lut = None
+    except (OSError, ValueError):
+        lut = None
+
+    if lut is None:
+        lut = build_lut(colors, metric)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # 先写临时文件再原子替换，避免并发进程读到半个文件
+            fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, lut)
+                os.replace(tmp_path, path)
+            except OSError:
+                os.remove(tmp_path)
+                raise
+        except OSError:
+            pass  # 缓存目录不可写时仅在内存中使用
+    return lut
+
+
+def lut_indices(pixels, lut):
+    """用查找表把 uint8 像素映射为调色板索引（形状与输入去掉最后一维相同）"""
+    pixels = np.asarray(pixels)
+    if pixels.dtype != np.uint8:
+        raise TypeError('查找表只适用于 uint8 像素')
+    return np.asarray(lut[pixels[..., 0], pixels[..., 1], pixels[..., 2]])
+
+
+def palette_indices(pixels, colors, metric='rgb', use_lut=True):
+    """最近调色板索引：uint8 输入走查找表，其他输入（如浮点误差扩散值）直接计算"""
+    pixels = np.asarray(pixels)
+    if use_lut and pixels.dtype == np.uint8:
+        return lut_indices(pixels, get_lut(colors, metric))
+    return METRICS[metric](pixels, colors)
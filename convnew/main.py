@@ -1,48 +1,52 @@
-#encoding: utf-8
-
-import sys
-import os
-import os.path
-import glob
-from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+#encoding: utf-8
+
+import sys
+import os
+import os.path
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
 import numpy as np
-import argparse
-import warnings
-warnings.filterwarnings('ignore')
-
-# E Ink E6 标准6色定义
-E6_COLORS = np.array([
-    [0, 0, 0],        # 黑色
-    [255, 255, 255],  # 白色  
-    [255, 255, 0],    # 黄色
-    [255, 0, 0],      # 红色
-    [0, 0, 255],      # 蓝色
-    [0, 255, 0]       # 绿色
-], dtype=np.float32)
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import re
+import warnings
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from convnew.dither import diffuse_indices, FLOYD_STEINBERG, DIFFUSION_KERNELS
+from convnew.ordered import ordered_indices, knoll_indices, THRESHOLD_MAPS
+from convnew.bmp import encode_bmp24, encode_packed4
+from convnew.check import check_bmp, check_packed, check_many, collect_check_paths
+from convnew.lut import palette_indices, METRICS
+from convnew.metrics import (
+    stage, new_record, finish_record, start_tracing, write_metrics, profiled, peak_rss,
+    check_output_path, check_profile_path,
+)
+from convnew.cache import cache_key, load_result, store_result, evict, DEFAULT_CACHE_SIZE
+from convnew.walk import iter_image_files
+from convnew.preprocess import preprocess_array, optimize_colors, check_factors, HAVE_NUMBA
+from convnew.pipeline import run_pipeline, DEFAULT_IO_THREADS
+from convnew.sync import (
+    load_manifest, save_manifest, remove_stale, plan_sync, update_entry, settings_digest,
+)
+from convnew.palette import (
+    E6_COLORS, E7_COLORS, E6_PANEL_CODES, BUILTIN_PALETTES, get_palette,
+)
+from convnew import __version__
 
-# 7色（E7/7C）固件颜色定义：黑、白、黄、红、蓝、绿、橙
-# 与 backup/GUI_BMPfile_7c.c 的判断保持一致（RGB: Orange = 255,128,0）
-E7_COLORS = np.array([
-    [0, 0, 0],        # 黑色
-    [255, 255, 255],  # 白色
-    [255, 255, 0],    # 黄色
-    [255, 0, 0],      # 红色
-    [0, 0, 255],      # 蓝色
-    [0, 255, 0],      # 绿色
-    [255, 128, 0],    # 橙色
+# 为了兼容性保留带跳过的版本
+E6_COLORS_WITH_SKIP = np.array([
+    E6_COLORS[0],     # 黑色
+    E6_COLORS[1],     # 白色
+    E6_COLORS[2],     # 黄色
+    E6_COLORS[3],     # 红色
+    [0, 0, 0],        # 跳过定义 (占位)
+    E6_COLORS[4],     # 蓝色
+    E6_COLORS[5]      # 绿色
 ], dtype=np.float32)
-
-# 为了兼容性保留带跳过的版本
-E6_COLORS_WITH_SKIP = np.array([
-    E6_COLORS[0],     # 黑色
-    E6_COLORS[1],     # 白色
-    E6_COLORS[2],     # 黄色
-    E6_COLORS[3],     # 红色
-    [0, 0, 0],        # 跳过定义 (占位)
-    E6_COLORS[4],     # 蓝色
-    E6_COLORS[5]      # 绿色
-], dtype=np.float32)
-
+
 def create_e6_palette():
     """创建E6专用调色板"""
     palette = []
@@ -62,7 +66,7 @@ def create_e7_palette():
     while len(palette) < 768:
         palette.extend([0, 0, 0])
     return palette
-
+
 def find_nearest_color(pixel, colors):
     """找到最近的目标调色板颜色"""
     pixel = np.asarray(pixel, dtype=np.float32)
@@ -70,455 +74,958 @@ def find_nearest_color(pixel, colors):
     return colors[np.argmin(distances)].astype(np.uint8)
 
 def floyd_steinberg_dither(img_array, colors):
-    """Floyd-Steinberg抖动算法（针对目标调色板）"""
-    height, width = img_array.shape[:2]
-    img_float = img_array.astype(np.float64).copy()
-    
-    # 误差分配系数
-    error_coeffs = [(1, 0, 7/16), (-1, 1, 3/16), (0, 1, 5/16), (1, 1, 1/16)]
-    
-    for y in range(height):
-        for x in range(width):
-            old_pixel = np.clip(img_float[y, x], 0, 255)
-            new_pixel = find_nearest_color(old_pixel, colors)
-            img_float[y, x] = new_pixel
-            
-            error = old_pixel - new_pixel
-            
-            # 分配误差到周围像素
-            for dx, dy, coeff in error_coeffs:
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < width and 0 <= ny < height:
-                    img_float[ny, nx] = np.clip(img_float[ny, nx] + error * coeff, 0, 255)
-    
-    return img_float.astype(np.uint8)
+    """Floyd-Steinberg抖动算法（针对目标调色板）
+
+    误差扩散由 convnew.dither 的编译内核完成（未安装 numba 时使用向量化回退实现），
+    输出与逐像素计算的结果逐像素一致。
+    """
+    indices = diffuse_indices(img_array, colors, FLOYD_STEINBERG)
+    return colors.astype(np.uint8)[indices]
 
 def ordered_dither(img_array, colors):
     """有序抖动（Bayer矩阵）针对目标调色板"""
-    height, width = img_array.shape[:2]
-    
-    # 4x4 Bayer矩阵
-    bayer = np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]]) * 16
-    bayer_tiled = np.tile(bayer, (height // 4 + 1, width // 4 + 1))[:height, :width]
-    
-    # 添加抖动噪声
-    dithered = np.clip(img_array.astype(np.float32) + bayer_tiled[:,:,np.newaxis] - 128, 0, 255)
-    
-    # 向量化量化
-    result = dithered.reshape(-1, 3)
-    for i in range(result.shape[0]):
-        result[i] = find_nearest_color(result[i], colors)
-    
-    return result.reshape(height, width, 3).astype(np.uint8)
+    return colors.astype(np.uint8)[ordered_dither_indices(img_array, colors)]
+
+def ordered_dither_indices(img_array, colors, metric='rgb', threshold_map='bayer4'):
+    """有序抖动，返回调色板索引平面
+
+    阈值图见 convnew.ordered.THRESHOLD_MAPS；默认的 bayer4 即原先的 4x4 Bayer矩阵。
+    """
+    return ordered_indices(img_array, colors, threshold_map, metric)
 
 def simple_quantize(img_array, colors):
     """简单量化（无抖动）针对目标调色板"""
-    # 向量化处理
-    shape = img_array.shape
-    result = img_array.reshape(-1, 3)
-    for i in range(result.shape[0]):
-        result[i] = find_nearest_color(result[i], colors)
-    return result.reshape(shape).astype(np.uint8)
+    return colors.astype(np.uint8)[palette_indices(img_array, colors)]
 
 def validate_colors(img_array, colors):
     """验证并修正所有像素为目标调色板中的有效颜色"""
-    height, width = img_array.shape[:2]
-    result = img_array.reshape(-1, 3)
-    
-    # 向量化处理，更高效
-    for i in range(result.shape[0]):
-        result[i] = find_nearest_color(result[i], colors)
-    
-    return result.reshape(height, width, 3)
-
-def resize_image(img, target_w, target_h, mode):
-    """统一的图像缩放函数"""
-    if mode == 'fit':
-        # 保持比例适应
-        img.thumbnail((target_w, target_h), Image.Resampling.LANCZOS)
-        # 创建白色背景并居中
-        new_img = Image.new('RGB', (target_w, target_h), (255, 255, 255))
-        left = (target_w - img.width) // 2
-        top = (target_h - img.height) // 2
-        new_img.paste(img, (left, top))
-        return new_img
-        
-    elif mode == 'fill':
-        # 填充整个区域（可能裁剪）
-        img_ratio = img.width / img.height
-        target_ratio = target_w / target_h
-        
-        if img_ratio > target_ratio:
-            new_h = target_h
-            new_w = int(target_h * img_ratio)
-        else:
-            new_w = target_w
-            new_h = int(target_w / img_ratio)
-        
-        img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-        # 裁剪中心区域
-        left = (new_w - target_w) // 2
-        top = (new_h - target_h) // 2
-        return img.crop((left, top, left + target_w, top + target_h))
-        
-    else:  # stretch
-        # 拉伸到目标尺寸
-        return img.resize((target_w, target_h), Image.Resampling.LANCZOS)
-
-def test_firmware_compatibility(bmp_path, colors=E6_COLORS):
-    """测试BMP文件是否与固件完全兼容（基于给定调色板）"""
-    try:
-        img = Image.open(bmp_path)
-        pixels = np.array(img).reshape(-1, 3)
-        total_pixels = len(pixels)
+    fixed = colors.astype(np.uint8)[palette_indices(img_array, colors)]
+    return fixed.astype(img_array.dtype, copy=False)
+
+def resize_image(img, target_w, target_h, mode):
+    """统一的图像缩放函数"""
+    if mode == 'fit':
+        # 保持比例适应
+        img.thumbnail((target_w, target_h), Image.Resampling.LANCZOS)
+        # 创建白色背景并居中
+        new_img = Image.new('RGB', (target_w, target_h), (255, 255, 255))
+        left = (target_w - img.width) // 2
+        top = (target_h - img.height) // 2
+        new_img.paste(img, (left, top))
+        return new_img
         
-        # 向量化检查
-        valid_mask = np.zeros(total_pixels, dtype=bool)
-        for color in colors.astype(np.uint8):
-            valid_mask |= np.all(pixels == color, axis=1)
+    elif mode == 'fill':
+        # 填充整个区域（可能裁剪）
+        img_ratio = img.width / img.height
+        target_ratio = target_w / target_h
+        
+        if img_ratio > target_ratio:
+            new_h = target_h
+            new_w = int(target_h * img_ratio)
+        else:
+            new_w = target_w
+            new_h = int(target_w / img_ratio)
         
-        incompatible_count = np.sum(~valid_mask)
+        img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
+        # 裁剪中心区域
+        left = (new_w - target_w) // 2
+        top = (new_h - target_h) // 2
+        return img.crop((left, top, left + target_w, top + target_h))
+        
+    else:  # stretch
+        # 拉伸到目标尺寸
+        return img.resize((target_w, target_h), Image.Resampling.LANCZOS)
+
+def test_firmware_compatibility(bmp_path, colors=E6_COLORS, log=print):
+    """测试BMP文件是否与固件完全兼容（基于给定调色板）
+
+    bmp_path 也可以是文件对象（如内存中的 BytesIO）。像素行按块读取并查表检查。
+    log 用于输出测试结果（默认打印到标准输出）。
+    """
+    try:
+        result = check_bmp(bmp_path, colors)
+        total_pixels = result['total_pixels']
+        incompatible_count = result['bad_pixels']
         is_compatible = incompatible_count == 0
-        
-        if is_compatible:
-            print(f'✓ 固件兼容性测试通过: 所有{total_pixels}个像素都是有效的E6颜色')
-        else:
-            print(f'✗ 固件兼容性测试失败: 发现{incompatible_count}个不兼容像素')
-            if incompatible_count <= 10:
-                invalid_indices = np.where(~valid_mask)[0][:10]
-                img_shape = np.array(img).shape
-                for idx in invalid_indices:
-                    y, x = idx // img_shape[1], idx % img_shape[1]
-                    r, g, b = pixels[idx]
-                    print(f'  位置({x},{y}): RGB({r},{g},{b})')
+        
+        if is_compatible:
+            log(f'✓ 固件兼容性测试通过: 所有{total_pixels}个像素都是有效的E6颜色')
+        else:
+            log(f'✗ 固件兼容性测试失败: 发现{incompatible_count}个不兼容像素')
+            if incompatible_count <= 10:
+                for x, y, r, g, b in result['samples']:
+                    log(f'  位置({x},{y}): RGB({r},{g},{b})')
         
         return is_compatible, incompatible_count
     except Exception as e:
-        print(f'测试失败: {e}')
+        log(f'测试失败: {e}')
         return False, 0
-
-def preprocess_image(img, config):
-    """预处理图像"""
-    # 确保RGB模式
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    
-    # 应用各种增强
-    enhancements = [
-        ('auto_balance', lambda i: ImageOps.autocontrast(i, cutoff=2), True),
-        ('denoise', lambda i: i.filter(ImageFilter.MedianFilter(size=3)), False),
-        ('color_enhance', lambda i, v: ImageEnhance.Color(i).enhance(v), 1.0),
-        ('contrast', lambda i, v: ImageEnhance.Contrast(i).enhance(v), 1.0),
-        ('brightness', lambda i, v: ImageEnhance.Brightness(i).enhance(v), 1.0),
-        ('sharpen', lambda i, v: ImageEnhance.Sharpness(i).enhance(v) if v > 1.0 else i, 1.0),
-        ('edge_enhance', lambda i: i.filter(ImageFilter.EDGE_ENHANCE), False)
-    ]
-    
-    for key, func, default in enhancements:
-        val = config.get(key, default)
-        if key in ['auto_balance', 'denoise', 'edge_enhance']:
-            if val:
-                img = func(img)
-        else:
-            if val != default:
-                img = func(img, val)
-    
-    return img
-
-def optimize_colors(img_array):
-    """优化颜色以适应6色显示"""
-    result = img_array.astype(np.float32)
-    
-    # 向量化处理
-    r, g, b = result[:,:,0], result[:,:,1], result[:,:,2]
-    
-    # 计算主色调
-    max_vals = np.maximum(np.maximum(r, g), b)
-    min_vals = np.minimum(np.minimum(r, g), b)
-    
-    # 增强纯色倾向的mask
-    strong_color_mask = (max_vals - min_vals) > 80
-    
-    # 应用增强
-    enhance_factor = 1.2
-    reduce_factor = 0.85
-    
-    # 红色主导
-    red_mask = strong_color_mask & (r == max_vals)
-    result[red_mask, 0] = np.minimum(255, result[red_mask, 0] * enhance_factor)
-    result[red_mask, 1:3] *= reduce_factor
-    
-    # 绿色主导
-    green_mask = strong_color_mask & (g == max_vals) & ~red_mask
-    result[green_mask, 1] = np.minimum(255, result[green_mask, 1] * enhance_factor)
-    result[green_mask, 0] *= reduce_factor
-    result[green_mask, 2] *= reduce_factor
-    
-    # 蓝色主导
-    blue_mask = strong_color_mask & (b == max_vals) & ~red_mask & ~green_mask
-    result[blue_mask, 2] = np.minimum(255, result[blue_mask, 2] * enhance_factor)
-    result[blue_mask, 0:2] *= reduce_factor
-    
-    # 特殊颜色优化
-    # 黄色
-    yellow_mask = (r > 200) & (g > 200) & (b < 50)
-    result[yellow_mask] = [255, 255, 0]
-    
-    # 红色
-    pure_red_mask = (r > 200) & (g < 100) & (b < 100)
-    result[pure_red_mask] = [255, 0, 0]
-    
-    # 绿色
-    pure_green_mask = (r < 100) & (g > 200) & (b < 100)
-    result[pure_green_mask] = [0, 255, 0]
-    
-    # 蓝色
-    pure_blue_mask = (r < 100) & (g < 100) & (b > 200)
-    result[pure_blue_mask] = [0, 0, 255]
-    
-    return np.clip(result, 0, 255).astype(np.uint8)
-
-def process_single_image(input_file, args, config):
-    """处理单个图像文件"""
-    if not os.path.isfile(input_file):
-        print(f'警告：文件 {input_file} 不存在，跳过')
-        return False
-    
-    print(f'\n处理图像: {input_file}')
-    print(f'预设: {args.preset}, 抖动: {args.method}, 调色板: {args.palette.upper()}')
-    
-    try:
-        # 打开并转换为RGB
-        img = Image.open(input_file).convert('RGB')
-        original_size = img.size
-        
-        # 确定目标尺寸
-        target_sizes = {
-            'landscape': (800, 480),
-            'portrait': (480, 800),
-            'auto': (800, 480) if img.width > img.height else (480, 800)
-        }
-        target_w, target_h = target_sizes[args.dir]
-        
-        print(f'原始尺寸: {original_size[0]}x{original_size[1]}')
-        print(f'目标尺寸: {target_w}x{target_h}')
-        
-        # 调整尺寸
-        img = resize_image(img, target_w, target_h, args.mode)
-        
-        print('应用预处理...')
-        img = preprocess_image(img, config)
-        img_array = np.array(img, dtype=np.uint8)
-        
-        # 颜色优化 - 默认关闭以保留细节
-        if config.get('optimize_colors', False):
-            print('优化颜色...')
-            img_array = optimize_colors(img_array)
-        
-        # 应用量化
-        print(f'应用{args.method}量化...')
-        
-        # 选择量化方法
-        target_colors = E6_COLORS if args.palette == 'e6' else E7_COLORS
-        quantize_func = {
-            'floyd': lambda a: floyd_steinberg_dither(a, target_colors),
-            'ordered': lambda a: ordered_dither(a, target_colors),
-            'none': lambda a: simple_quantize(a, target_colors)
-        }.get(args.method, lambda a: simple_quantize(a, target_colors))
-        
-        quantized = quantize_func(img_array)
+
+def test_packed_compatibility(packed_path, codes=E6_PANEL_CODES, log=print):
+    """测试4bpp打包文件是否只包含有效的固件颜色编码
+
+    packed_path 也可以是文件对象。
+    """
+    try:
+        result = check_packed(packed_path, codes)
+        total_pixels = result['total_pixels']
+        incompatible_count = result['bad_pixels']
+        is_compatible = incompatible_count == 0
         
-        # 验证颜色（总是启用以确保固件兼容）
-        quantized = validate_colors(quantized, target_colors)
-        
-        if args.strict:
-            print('  已应用严格固件兼容模式')
-        
-        # 转换回PIL图像（确保RGB模式）
-        result_img = Image.fromarray(quantized, mode='RGB')
-        
-        # 创建调色板图像
-        pal_img = Image.new('P', (1, 1))
-        if args.palette == 'e6':
-            pal_img.putpalette(create_e6_palette())
+        if is_compatible:
+            log(f'✓ 固件兼容性测试通过: 所有{total_pixels}个像素都是有效的颜色编码')
         else:
-            pal_img.putpalette(create_e7_palette())
+            log(f'✗ 固件兼容性测试失败: 发现{incompatible_count}个无效颜色编码')
+            if incompatible_count <= 10:
+                for x, y, code in result['samples']:
+                    log(f'  位置({x},{y}): 编码{code}')
         
-        # 量化到目标调色板
-        final_img = result_img.convert('RGB').quantize(palette=pal_img).convert('RGB')
-        
-        # 保存BMP文件（24位格式，固件要求）
-        output_file = os.path.splitext(input_file)[0] + f'_{args.palette}.bmp'
-        final_img.save(output_file, 'BMP')  # PIL会自动使用24位BMP格式
-        
-        # 保存RGB预览
-        preview_file = os.path.splitext(input_file)[0] + f'_preview.png'
-        # 转回RGB保存预览
-        preview_img = final_img.convert('RGB')
-        preview_img.save(preview_file, 'PNG')
-        
-        print(f'✓ 转换完成: {output_file}')
-        print(f'  预览文件: {preview_file}')
-        print(f'  最终尺寸: {target_w}x{target_h}')
-        
-        # 自动运行固件兼容性测试
-        print('\n运行固件兼容性测试...')
-        test_firmware_compatibility(output_file, colors=target_colors)
+        return is_compatible, incompatible_count
+    except Exception as e:
+        log(f'✗ 固件兼容性测试失败: {e}')
+        return False, 0
+
+def preprocess_image(img, config, engine=None):
+    """预处理图像
+
+    engine: None 自动选择（有 numba 时使用融合引擎，否则逐步调用 PIL）；'pil' 逐步调用
+    PIL；'numba'/'numpy' 使用 convnew.preprocess 的融合引擎，结果与 PIL 逐字节相同
+    """
+    # 确保RGB模式
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if engine is None:
+        engine = 'numba' if HAVE_NUMBA else 'pil'
+    if engine != 'pil':
+        return Image.fromarray(preprocess_array(np.asarray(img), config, engine))
+    
+    # 应用各种增强
+    enhancements = [
+        ('auto_balance', lambda i: ImageOps.autocontrast(i, cutoff=2), True),
+        ('denoise', lambda i: i.filter(ImageFilter.MedianFilter(size=3)), False),
+        ('color_enhance', lambda i, v: ImageEnhance.Color(i).enhance(v), 1.0),
+        ('contrast', lambda i, v: ImageEnhance.Contrast(i).enhance(v), 1.0),
+        ('brightness', lambda i, v: ImageEnhance.Brightness(i).enhance(v), 1.0),
+        ('sharpen', lambda i, v: ImageEnhance.Sharpness(i).enhance(v) if v > 1.0 else i, 1.0),
+        ('edge_enhance', lambda i: i.filter(ImageFilter.EDGE_ENHANCE), False)
+    ]
+    
+    for key, func, default in enhancements:
+        val = config.get(key, default)
+        if key in ['auto_balance', 'denoise', 'edge_enhance']:
+            if val:
+                img = func(img)
+        else:
+            if val != default:
+                img = func(img, val)
+    
+    return img
+
+# 预设配置
+PRESETS = {
+    'photo': {
+        'color_enhance': 1.5,
+        'contrast': 1.3,
+        'brightness': 1.0,
+        'sharpen': 1.2,
+        'denoise': True,
+        'auto_balance': True,
+        'edge_enhance': False,
+        'optimize_colors': False
+    },
+    'art': {
+        'color_enhance': 1.8,
+        'contrast': 1.5,
+        'brightness': 1.0,
+        'sharpen': 1.4,
+        'denoise': False,
+        'auto_balance': True,
+        'edge_enhance': False,
+        'optimize_colors': False
+    },
+    'text': {
+        'color_enhance': 1.0,
+        'contrast': 1.7,
+        'brightness': 1.1,
+        'sharpen': 1.6,
+        'denoise': False,
+        'auto_balance': True,
+        'edge_enhance': True,
+        'optimize_colors': False
+    },
+    'logo': {
+        'color_enhance': 2.0,
+        'contrast': 1.4,
+        'brightness': 1.0,
+        'sharpen': 1.3,
+        'denoise': False,
+        'auto_balance': False,
+        'edge_enhance': False,
+        'optimize_colors': False
+    }
+}
+
+def build_config(preset='photo', enhance=None, contrast=None, brightness=None):
+    """根据预设生成预处理配置，并应用覆盖参数
+
+    系数为非有限值或超出范围时抛出 ValueError。
+    """
+    config = PRESETS[preset].copy()
+    if enhance is not None:
+        config['color_enhance'] = enhance
+    if contrast is not None:
+        config['contrast'] = contrast
+    if brightness is not None:
+        config['brightness'] = brightness
+    check_factors(config)
+    return config
+
+def conversion_settings(args, config):
+    """影响转换结果的全部设置（转换缓存键的一部分）"""
+    # 调色板按内容哈希记录，调色板文件修改后缓存和同步清单随之失效
+    return {'config': config, 'method': args.method, 'palette': get_palette(args.palette)['key'],
+            'dir': args.dir, 'mode': args.mode, 'draft': not getattr(args, 'no_draft', False),
+            'metric': getattr(args, 'metric', 'rgb'), 'serpentine': getattr(args, 'serpentine', False),
+            'threshold_map': getattr(args, 'threshold_map', 'bayer4'), 'version': __version__}
+
+def get_palette_colors(palette):
+    """返回调色板（名称、调色板文件路径或调色板字典）的输出颜色（固件颜色）"""
+    return get_palette(palette)['output']
+
+def get_match_colors(palette):
+    """返回调色板用于匹配和误差扩散的颜色（面板实际显示的颜色）"""
+    return get_palette(palette)['match']
+
+def get_panel_codes(palette):
+    """返回调色板对应的固件颜色编码"""
+    return get_palette(palette)['codes']
+
+# 输出格式对应的文件扩展名
+OUTPUT_EXTENSIONS = {'bmp': 'bmp', 'packed': 'bin', 'raw': 'bin'}
+
+# 本工具写在输入文件旁边的输出文件名（目录模式不会把它们当作输入）
+OUTPUT_NAME_PATTERN = re.compile(r'_(e6|e7)\.(bmp|bin)$|_preview\.png$', re.IGNORECASE)
+
+def output_paths(input_file, args):
+    """输入文件默认生成的输出文件：[转换结果, 预览图（未指定 --no-preview 时）]
+
+    指定 --output-dir 时输出写到该目录下，并保持与输入目录相同的子目录结构。
+    """
+    base = os.path.splitext(input_file)[0]
+    if getattr(args, 'output_dir', None):
+        root = args.input_path if os.path.isdir(args.input_path) else os.path.dirname(input_file)
+        base = os.path.join(args.output_dir, os.path.relpath(base, root))
+    paths = [base + f'_{get_palette(args.palette)["panel"]}.{OUTPUT_EXTENSIONS[args.format]}']
+    if not args.no_preview:
+        paths.append(base + '_preview.png')
+    return paths
+
+def is_output_file(path):
+    """是否为本工具生成的输出文件"""
+    return OUTPUT_NAME_PATTERN.search(os.path.basename(path)) is not None
+
+def encode_output(indices, palette, output_format='bmp'):
+    """把索引平面编码为输出格式：bmp（24位BMP）、packed（带头4bpp）或 raw（无头4bpp）"""
+    if output_format == 'bmp':
+        return encode_bmp24(indices, get_palette_colors(palette))
+    return encode_packed4(indices, get_panel_codes(palette), header=output_format == 'packed')
+
+def get_target_size(img, direction):
+    """确定目标尺寸"""
+    target_sizes = {
+        'landscape': (800, 480),
+        'portrait': (480, 800),
+        'auto': (800, 480) if img.width > img.height else (480, 800)
+    }
+    return target_sizes[direction]
+
+def quantize_indices(img_array, colors, method, metric='rgb', serpentine=False, threads=1,
+                     threshold_map='bayer4'):
+    """按抖动方法量化，直接返回 (H, W) uint8 调色板索引平面
+
+    method 为 DIFFUSION_KERNELS 中的误差扩散核名称、'ordered'、'knoll' 或 'none'；
+    serpentine 和 threads（并行线程数）只影响误差扩散，threshold_map 只影响
+    ordered 和 knoll。索引平面按构造只包含有效颜色，无需再做颜色校验。
+    """
+    if method in DIFFUSION_KERNELS:
+        return diffuse_indices(img_array, colors, DIFFUSION_KERNELS[method], metric=metric,
+                               serpentine=serpentine, threads=threads)
+    quantize_func = {
+        'ordered': lambda a: ordered_dither_indices(a, colors, metric, threshold_map),
+        'knoll': lambda a: knoll_indices(a, colors, threshold_map, metric),
+        'none': lambda a: palette_indices(a, colors, metric)
+    }.get(method, lambda a: palette_indices(a, colors, metric))
+    return quantize_func(img_array)
+
+def open_image(image, direction=None):
+    """把各种输入（数组、PIL图像、字节串、路径或文件对象）解码为新的RGB模式PIL图像
+
+    给出 direction 时，JPEG 使用 draft 模式直接按 1/2、1/4 或 1/8 的 DCT 缩放解码，
+    得到不小于该方向目标尺寸的最小分辨率，省去解码之后又被缩小丢弃的像素。
+    原始尺寸保存在 img.info['original_size'] 中。
+    """
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(image).convert('RGB')
+    if isinstance(image, Image.Image):
+        return image.convert('RGB')
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = io.BytesIO(image)
+    img = Image.open(image)
+    img.info['original_size'] = img.size
+    if direction is not None:
+        img.draft('RGB', get_target_size(img, direction))  # 非JPEG格式时不起作用
+    return img.convert('RGB')
+
+def convert_indices(image, palette='e6', method='floyd', preset='photo', direction='auto',
+                    mode='fit', config=None, log=None, record=None, draft=True, metric='rgb',
+                    serpentine=False, threads=1, threshold_map='bayer4'):
+    """把图像转换为调色板索引平面（参数同 convert），返回 (H, W) uint8 数组
+
+    record 为 convnew.metrics.new_record() 创建的记录时，累加各阶段的耗时。
+    draft 为 False 时总是完整解码JPEG（见 open_image）。
+    """
+    log = log or (lambda message: None)
+    with stage(record, 'open'):
+        img = open_image(image, direction if draft else None)
+    if config is None:
+        config = build_config(preset)
+
+    original_size = img.info.get('original_size', img.size)
+    target_w, target_h = get_target_size(img, direction)
+
+    log(f'原始尺寸: {original_size[0]}x{original_size[1]}')
+    log(f'目标尺寸: {target_w}x{target_h}')
+
+    # 调整尺寸
+    with stage(record, 'resize'):
+        img = resize_image(img, target_w, target_h, mode)
+
+    log('应用预处理...')
+    with stage(record, 'preprocess'):
+        img = preprocess_image(img, config)
+        img_array = np.array(img, dtype=np.uint8)
+
+    # 颜色优化 - 默认关闭以保留细节
+    if config.get('optimize_colors', False):
+        log('优化颜色...')
+        with stage(record, 'optimize'):
+            optimize_colors(img_array, out=img_array)
+
+    # 应用量化
+    log(f'应用{method}量化...')
+    with stage(record, 'quantize'):
+        return quantize_indices(img_array, get_match_colors(palette), method, metric, serpentine,
+                                threads, threshold_map)
+
+def convert(image, palette='e6', method='floyd', preset='photo', direction='auto',
+            mode='fit', config=None, log=None, metric='rgb', serpentine=False, threads=1,
+            threshold_map='bayer4'):
+    """把图像转换为墨水屏调色板图像（库接口，不读写任何输出文件）
+
+    image 可以是文件路径、文件对象（如BytesIO）、图像字节串、PIL图像或
+    (H, W, 3) uint8 数组。输入为数组时返回数组，否则返回RGB模式的PIL图像。
+    config 为 None 时使用 preset 对应的预设配置；log 用于输出进度信息。
+    metric 为匹配调色板颜色的距离度量（'rgb'、'weighted'、'lab'、'ciede2000'）。
+    method 为误差扩散核名称（见 convnew.dither.DIFFUSION_KERNELS）、'ordered'、'knoll'
+    或 'none'；serpentine 为真时误差扩散使用蛇形扫描；threads 大于1时误差扩散用多线程
+    并行处理（需要 numba），结果与单线程相同；threshold_map 为 ordered/knoll 使用的
+    阈值图（见 convnew.ordered.THRESHOLD_MAPS）。
+    """
+    indices = convert_indices(image, palette=palette, method=method, preset=preset,
+                              direction=direction, mode=mode, config=config, log=log,
+                              metric=metric, serpentine=serpentine, threads=threads,
+                              threshold_map=threshold_map)
+    result = get_palette_colors(palette).astype(np.uint8)[indices]
+    return result if isinstance(image, np.ndarray) else Image.fromarray(result, mode='RGB')
+
+def convert_bytes(data, palette='e6', output_format='bmp', **options):
+    """图像字节串 → 固件文件字节串，全程在内存中完成
+
+    output_format 见 encode_output，其余参数同 convert。
+    """
+    indices = convert_indices(data, palette=palette, **options)
+    return encode_output(indices, palette, output_format)
+
+def quantize_batch(frames, palette='e6', method='ordered', metric='rgb', threshold_map='bayer4',
+                   serpentine=False):
+    """量化一批同尺寸的帧：(N, H, W, 3) uint8 → (N, H, W) uint8 调色板索引
+
+    none、ordered 和 knoll 对整批只做一次向量化计算（一次平铺阈值图、一次查表），
+    误差扩散本质上是顺序的，逐帧处理。调色板、查找表和阈值图整批共用。
+    """
+    frames = np.asarray(frames, dtype=np.uint8)
+    if frames.ndim != 4 or frames.shape[-1] != 3:
+        raise ValueError(f'frames 应为 (N, H, W, 3) 数组，实际形状为 {frames.shape}')
+    colors = get_match_colors(palette)
+    if method in DIFFUSION_KERNELS:
+        indices = np.empty(frames.shape[:3], dtype=np.uint8)
+        for i, frame in enumerate(frames):
+            indices[i] = quantize_indices(frame, colors, method, metric, serpentine)
+        return indices
+    return quantize_indices(frames, colors, method, metric, threshold_map=threshold_map)
+
+def convert_batch(images, palette='e6', method='ordered', preset='photo', direction='auto',
+                  mode='fit', config=None, size=None, output_format=None, metric='rgb',
+                  threshold_map='bayer4', serpentine=False):
+    """批量转换大量小图像（缩略图、图标等），省去逐张转换的固定开销
+
+    images 为 convert 接受的输入组成的序列。每张图像解码、缩放并预处理后放入一个
+    (N, H, W, 3) 数组，再由 quantize_batch 一次量化；调色板和预处理配置只解析一次。
+    size 为 (宽, 高) 时所有图像缩放到该尺寸（默认为 direction 对应的屏幕尺寸，
+    此时所有图像的方向必须相同）。
+    返回 (N, H, W) 调色板索引；给出 output_format（见 encode_output）时返回
+    每张图像编码后的字节串列表。索引按构造只包含有效颜色，不需要再读回校验。
+    """
+    palette = get_palette(palette)
+    if config is None:
+        config = build_config(preset)
+
+    frames = None
+    for i, image in enumerate(images):
+        img = open_image(image, None if size else direction)
+        target_w, target_h = size or get_target_size(img, direction)
+        if frames is None:
+            frames = np.empty((len(images), target_h, target_w, 3), dtype=np.uint8)
+        elif frames.shape[1:3] != (target_h, target_w):
+            raise ValueError('批量转换的图像必须缩放到相同尺寸，请指定 size 或 direction')
+        frames[i] = np.asarray(preprocess_image(resize_image(img, target_w, target_h, mode), config))
+        if config.get('optimize_colors', False):
+            optimize_colors(frames[i], out=frames[i])
+    if frames is None:
+        return [] if output_format else np.empty((0, 0, 0), dtype=np.uint8)
+
+    indices = quantize_batch(frames, palette, method, metric, threshold_map, serpentine)
+    if output_format:
+        return [encode_output(frame, palette, output_format) for frame in indices]
+    return indices
+
+def read_input(input_file, args, config, record=None, log=print):
+    """读取阶段（I/O）：读入输入文件，查询转换缓存，未命中时解码图像
+
+    返回 (RGB图像, 缓存的索引平面, 缓存键)：缓存命中时图像为 None，
+    未命中时索引平面为 None；未使用缓存时缓存键为 None。
+    """
+    # 使用转换缓存时需要输入的完整字节来计算键
+    use_cache = getattr(args, 'cache', False)
+    with stage(record, 'open'):
+        if input_file == '-':
+            source = sys.stdin.buffer.read()
+        elif use_cache:
+            with open(input_file, 'rb') as f:
+                source = f.read()
+        else:
+            source = input_file
+
+    key = None
+    if use_cache:
+        key = cache_key(source, conversion_settings(args, config))
+        indices = load_result(key, args.cache_dir)
+        if record is not None:
+            record['cache'] = 'miss' if indices is None else 'hit'
+        if indices is not None:
+            log('  命中转换缓存，跳过转换')
+            return None, indices, key
+
+    with stage(record, 'open'):
+        return open_image(source, None if getattr(args, 'no_draft', False) else args.dir), None, key
+
+def compute_indices(image, args, config, key=None, record=None, log=print):
+    """计算阶段：缩放、预处理并量化为调色板索引（给出缓存键时写入转换缓存）"""
+    indices = convert_indices(image, palette=args.palette, method=args.method,
+                              direction=args.dir, mode=args.mode, config=config,
+                              log=log, record=record, metric=getattr(args, 'metric', 'rgb'),
+                              serpentine=getattr(args, 'serpentine', False),
+                              threads=getattr(args, 'dither_threads', 1),
+                              threshold_map=getattr(args, 'threshold_map', 'bayer4'))
+    if key is not None:
+        store_result(key, indices, args.cache_dir)
+    return indices
+
+def write_outputs(input_file, indices, args, record=None, log=print, stdout=None):
+    """写出阶段（I/O）：编码并写出结果、保存预览图，然后运行固件兼容性测试"""
+    from_stdin = input_file == '-'
+    output_file = args.output or ('-' if from_stdin else output_paths(input_file, args)[0])
+    to_stdout = output_file == '-'
+    target_colors = get_palette_colors(args.palette)
+    target_h, target_w = indices.shape
+
+    if args.strict:
+        log('  已应用严格固件兼容模式')
+
+    # 直接从索引平面在内存中编码输出，写出后无需再从磁盘读回
+    with stage(record, 'save'):
+        output_data = encode_output(indices, args.palette, args.format)
+        if to_stdout:
+            stdout = stdout or sys.stdout
+            stdout.buffer.write(output_data)
+            stdout.flush()
+        else:
+            if getattr(args, 'output_dir', None):
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            with open(output_file, 'wb') as f:
+                f.write(output_data)
+    log(f'✓ 转换完成: {"<stdout>" if to_stdout else output_file}')
+
+    # 保存RGB预览（输出到标准输出或指定 --no-preview 时跳过）
+    if not (args.no_preview or to_stdout or from_stdin):
+        preview_file = output_paths(input_file, args)[1]
+        with stage(record, 'preview'):
+            preview_img = Image.fromarray(target_colors.astype(np.uint8)[indices], mode='RGB')
+            preview_img.save(preview_file, 'PNG')
+        log(f'  预览文件: {preview_file}')
+    log(f'  最终尺寸: {target_w}x{target_h}')
+
+    # 自动运行固件兼容性测试（直接检查内存中的输出数据）
+    if not args.no_verify:
+        log('\n运行固件兼容性测试...')
+        with stage(record, 'verify'):
+            if args.format == 'bmp':
+                test_firmware_compatibility(io.BytesIO(output_data), colors=target_colors, log=log)
+            else:
+                test_packed_compatibility(io.BytesIO(output_data),
+                                          codes=get_panel_codes(args.palette), log=log)
+
+def process_single_image(input_file, args, config, record=None):
+    """处理单个图像文件（input_file 为 '-' 时从标准输入读取）
+
+    依次执行 read_input、compute_indices 和 write_outputs 三个阶段。
+    record 不为 None 时在其中记录各阶段的指标（见 convnew.metrics）。
+    """
+    from_stdin = input_file == '-'
+    if not from_stdin and not os.path.isfile(input_file):
+        print(f'警告：文件 {input_file} 不存在，跳过')
+        return False
+    
+    # 输出路径：默认写在输入文件旁边；'-' 表示写到标准输出
+    to_stdout = (args.output or ('-' if from_stdin else '')) == '-'
+    stdout = sys.stdout
+    
+    # 标准输出用于传输BMP数据时，日志改写到标准错误
+    with contextlib.redirect_stdout(sys.stderr if to_stdout else stdout):
+        print(f'\n处理图像: {"<stdin>" if from_stdin else input_file}')
+        print(f'预设: {args.preset}, 抖动: {args.method}, '
+              f'调色板: {get_palette(args.palette)["name"].upper()}')
         
+        try:
+            image, indices, key = read_input(input_file, args, config, record)
+            if indices is None:
+                indices = compute_indices(image, args, config, key, record)
+            write_outputs(input_file, indices, args, record, stdout=stdout)
+            peak = peak_rss()
+            if peak:
+                print(f'  进程峰值内存: {peak / (1 << 20):.0f} MB')
+            return True
+            
+        except Exception as e:
+            print(f'✗ 处理 {input_file} 时出错: {str(e)}')
+            return False
+
+def _process_with_metrics(input_file, args, config):
+    """处理单个文件，返回 (是否成功, 指标记录)；只有同时指定 --trace-alloc 时才跟踪内存分配"""
+    if getattr(args, 'metrics', None) and getattr(args, 'trace_alloc', False):
+        start_tracing()
+    record = new_record(input_file)
+    ok = process_single_image(input_file, args, config, record)
+    return ok, finish_record(record, ok)
+
+def _save_metrics(records, args):
+    """写出指标文件，失败时报告错误并返回 False"""
+    try:
+        write_metrics(records, args.metrics, args.metrics_format)
         return True
-        
-    except Exception as e:
-        print(f'✗ 处理 {input_file} 时出错: {str(e)}')
-        return False
-
-# 参数解析
-parser = argparse.ArgumentParser(
-    description='E Ink E6 六色墨水屏图像转换工具',
-    formatter_class=argparse.RawDescriptionHelpFormatter,
-    epilog='''
-使用示例:
-  python main.py image.jpg                       # 处理单个文件
-  python main.py /path/to/directory              # 处理目录中所有图片
-  python main.py image.jpg --preset art          # 艺术作品模式
-  python main.py ./photos --method ordered       # 对目录使用有序抖动
-  python main.py image.jpg --no-dither           # 无抖动
-    '''
-)
-
-parser.add_argument('input_path', type=str, help='输入图像文件或目录路径')
-parser.add_argument('--preset', choices=['photo', 'art', 'text', 'logo'], 
-                   default='photo', help='预设模式')
-parser.add_argument('--method', choices=['floyd', 'ordered', 'none'], 
-                   default='floyd', help='抖动方法')
-parser.add_argument('--dir', choices=['landscape', 'portrait', 'auto'], 
-                   default='auto', help='显示方向')
-parser.add_argument('--mode', choices=['fit', 'fill', 'stretch'], 
-                   default='fit', help='缩放模式')
-parser.add_argument('--no-dither', action='store_true', 
-                   help='禁用抖动')
-parser.add_argument('--palette', choices=['e6', 'e7'],
-                   default='e6', help='目标显示调色板：E6(6色) 或 E7(7色)')
-parser.add_argument('--enhance', type=float, default=None, 
-                   help='色彩增强系数 (1.0-2.0)')
-parser.add_argument('--contrast', type=float, default=None, 
-                   help='对比度系数 (1.0-2.0)')
-parser.add_argument('--brightness', type=float, default=None, 
-                   help='亮度系数 (0.8-1.2)')
-parser.add_argument('--strict', action='store_true',
-                   help='严格固件兼容模式（强制纯色输出）')
-parser.add_argument('--test-only', action='store_true',
-                   help='仅测试现有BMP文件的固件兼容性')
-
-args = parser.parse_args()
-
-# 检查输入路径
-if not os.path.exists(args.input_path):
-    print(f'错误：路径 {args.input_path} 不存在')
-    sys.exit(1)
-
-# 如果是仅测试模式
-if args.test_only:
-    if args.input_path.lower().endswith('.bmp'):
-        print(f'测试BMP文件的固件兼容性: {args.input_path}')
-        target_colors = E6_COLORS if args.palette == 'e6' else E7_COLORS
-        is_compatible, _ = test_firmware_compatibility(args.input_path, colors=target_colors)
-        sys.exit(0 if is_compatible else 1)
+    except OSError as e:
+        print(f'错误：无法写出指标文件 {args.metrics}: {e}')
+        return False
+
+def _process_captured(input_file, args, config):
+    """在子进程中处理单个文件，捕获其输出以免多个进程的日志交错"""
+    buffer = io.StringIO()
+    with contextlib.redirect_stdout(buffer):
+        ok, record = _process_with_metrics(input_file, args, config)
+    return ok, buffer.getvalue(), record
+
+def process_batch(image_files, args, config, jobs=1, on_record=None):
+    """批量处理文件，jobs > 1 时使用进程池并行；返回 (成功的文件数, 处理的文件数)
+
+    image_files 可以是列表，也可以是边遍历边产生路径的迭代器（如 iter_image_files），
+    并行时最多只有 2*jobs 个文件在排队，内存占用与文件总数无关。
+    on_record 为每个文件的指标记录调用一次（子进程异常退出的文件没有记录）。
+    """
+    total = len(image_files) if hasattr(image_files, '__len__') else None
+    progress = (lambda i: f'[{i}/{total}] ') if total is not None else (lambda i: f'[{i}] ')
+    success_count = 0
+    count = 0
+
+    if jobs <= 1 or total is not None and total <= 1:
+        for f in image_files:
+            count += 1
+            print('\n' + progress(count), end='')
+            ok, record = _process_with_metrics(f, args, config)
+            if on_record is not None:
+                on_record(record)
+            if ok:
+                success_count += 1
+        return success_count, count
+
+    files = iter(image_files)
+    max_workers = jobs if total is None else min(jobs, total)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+
+        def submit_more():
+            for f in itertools.islice(files, 2 * max_workers - len(futures)):
+                futures[executor.submit(_process_captured, f, args, config)] = f
+
+        submit_more()
+        while futures:
+            # 按完成顺序整段输出每个文件的日志，并补充新任务
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = futures.pop(future)
+                try:
+                    ok, log, record = future.result()
+                except Exception as e:  # 子进程异常退出（例如内存不足被终止）
+                    ok, log, record = False, f'\n✗ 处理 {path} 时出错: {str(e)}\n', None
+                if on_record is not None and record is not None:
+                    on_record(record)
+                count += 1
+                print('\n' + progress(count), end='')
+                print(log, end='', flush=True)
+                if ok:
+                    success_count += 1
+            submit_more()
+    return success_count, count
+
+def run_compatibility_tests(args):
+    """--test-only：检查单个文件，或并行检查目录/通配符匹配的所有文件"""
+    target_colors = get_palette_colors(args.palette)
+    codes = get_panel_codes(args.palette)
+
+    if os.path.isfile(args.input_path) and args.json is None:
+        if args.input_path.lower().endswith('.bmp'):
+            print(f'测试BMP文件的固件兼容性: {args.input_path}')
+            is_compatible, _ = test_firmware_compatibility(args.input_path, colors=target_colors)
+            return 0 if is_compatible else 1
+        elif args.input_path.lower().endswith('.bin'):
+            print(f'测试4bpp打包文件的固件兼容性: {args.input_path}')
+            is_compatible, _ = test_packed_compatibility(args.input_path, codes=codes)
+            return 0 if is_compatible else 1
+        else:
+            print('错误：--test-only 参数需要BMP或4bpp打包(.bin)文件、目录或通配符')
+            return 1
+
+    # JSON 写到标准输出时，日志改写到标准错误
+    with contextlib.redirect_stdout(sys.stderr if args.json == '-' else sys.stdout):
+        paths = collect_check_paths(args.input_path)
+        if not paths:
+            print('错误：未找到BMP或4bpp打包(.bin)文件')
+            return 1
+
+        jobs = args.jobs or os.cpu_count() or 1
+        print(f'测试 {len(paths)} 个文件的固件兼容性（并行进程数: {min(jobs, len(paths))}）...')
+        summary = check_many(paths, target_colors, codes, jobs=jobs)
+        summary['palette'] = args.palette
+
+        for failure in summary['failures'][:20]:
+            reason = failure['error'] or f'{failure["bad_pixels"]}个不兼容像素'
+            print(f'✗ {failure["path"]}: {reason}')
+        if summary['failed'] > 20:
+            print(f'  ... 还有 {summary["failed"] - 20} 个文件未通过')
+        print('=' * 60)
+        print(f'测试完成！通过: {summary["passed"]}/{summary["checked"]} 个文件, '
+              f'失败: {summary["failed"]} 个, 耗时 {summary["seconds"]:.2f} 秒')
+
+    if args.json == '-':
+        json.dump(summary, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    return 0 if summary['failed'] == 0 else 1
+
+def build_parser():
+    """构建命令行参数解析器"""
+    parser = argparse.ArgumentParser(
+        description='E Ink E6 六色墨水屏图像转换工具',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='''
+使用示例:
+  python -m convnew.main image.jpg                         # 处理单个文件
+  python -m convnew.main /path/to/directory                # 处理目录中所有图片
+  python -m convnew.main image.jpg --preset art            # 艺术作品模式
+  python -m convnew.main ./photos --method ordered         # 对目录使用有序抖动
+  python -m convnew.main image.jpg --method stucki --serpentine  # Stucki 误差扩散，蛇形扫描
+  python -m convnew.main image.jpg --no-dither             # 无抖动
+  python -m convnew.main bench --sizes 800x480             # 各阶段基准测试
+  python -m convnew.main serve --socket /tmp/convnew.sock  # 常驻转换服务（另见 serve --help）
+    '''
+    )
+
+    parser.add_argument('input_path', type=str,
+                       help="输入图像文件或目录路径（'-' 表示从标准输入读取）")
+    parser.add_argument('--preset', choices=list(PRESETS), 
+                       default='photo', help='预设模式')
+    parser.add_argument('--method', choices=list(DIFFUSION_KERNELS) + ['ordered', 'knoll', 'none'], 
+                       default='floyd',
+                       help='抖动方法：误差扩散（floyd、atkinson、jjn、stucki、burkes、sierra、'
+                            'sierra2、sierra-lite）、ordered(有序抖动)、knoll(调色板感知的有序抖动) '
+                            '或 none(不抖动)')
+    parser.add_argument('--threshold-map', choices=list(THRESHOLD_MAPS), default='bayer4',
+                       help='ordered/knoll 使用的阈值图：bayer4/bayer8/bayer16 或 bluenoise(64x64蓝噪声)')
+    parser.add_argument('--serpentine', action='store_true',
+                       help='误差扩散使用蛇形扫描（奇数行从右向左）')
+    parser.add_argument('--dither-threads', type=int, default=1, metavar='N',
+                       help='单张图像的误差扩散用 N 个线程并行处理（需要 numba，不能与 --serpentine '
+                            '同时使用）；结果与单线程完全相同，适合大尺寸单帧')
+    parser.add_argument('--metric', choices=list(METRICS), default='rgb',
+                       help='匹配调色板颜色的距离度量：rgb(RGB平方距离)、weighted(加权RGB)、'
+                            'lab(CIELAB ΔE76)、ciede2000(CIEDE2000)；非rgb度量首次使用时生成查找表并缓存')
+    parser.add_argument('--dir', choices=['landscape', 'portrait', 'auto'], 
+                       default='auto', help='显示方向')
+    parser.add_argument('--mode', choices=['fit', 'fill', 'stretch'], 
+                       default='fit', help='缩放模式')
+    parser.add_argument('--no-dither', action='store_true', 
+                       help='禁用抖动')
+    parser.add_argument('--palette', default='e6', metavar='PALETTE',
+                       help=f'目标显示调色板：{", ".join(BUILTIN_PALETTES)}（e6-measured 用实测颜色匹配），'
+                            f'或 .json/.gpl 调色板文件')
+    parser.add_argument('--enhance', type=float, default=None, 
+                       help='色彩增强系数 (1.0-2.0)')
+    parser.add_argument('--contrast', type=float, default=None, 
+                       help='对比度系数 (1.0-2.0)')
+    parser.add_argument('--brightness', type=float, default=None, 
+                       help='亮度系数 (0.8-1.2)')
+    parser.add_argument('--strict', action='store_true',
+                       help='严格固件兼容模式（强制纯色输出）')
+    parser.add_argument('--test-only', action='store_true',
+                       help='仅测试现有BMP/4bpp打包文件的固件兼容性（可传入目录或通配符）')
+    parser.add_argument('--json', type=str, default=None, metavar='PATH',
+                       help="仅测试模式下把汇总结果写为JSON（'-' 表示标准输出）")
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                       help='目录模式下并行处理的进程数（默认：CPU核心数）')
+    parser.add_argument('--output', '-o', type=str, default=None,
+                       help="单文件模式的输出文件路径（'-' 表示写到标准输出）")
+    parser.add_argument('--format', choices=list(OUTPUT_EXTENSIONS), default='bmp',
+                       help='输出格式：bmp(24位BMP)、packed(带文件头的4bpp打包数据)、'
+                            'raw(无文件头的4bpp打包数据)')
+    parser.add_argument('--no-preview', action='store_true',
+                       help='不保存PNG预览文件')
+    parser.add_argument('--no-verify', action='store_true',
+                       help='转换后不运行固件兼容性测试')
+    parser.add_argument('--metrics', type=str, default=None, metavar='PATH',
+                       help='把各阶段的耗时和CPU时间写到文件'
+                            '（.prom 为 Prometheus 文本格式，否则为 JSON Lines）')
+    parser.add_argument('--metrics-format', choices=['jsonl', 'prom'], default=None,
+                       help='指标文件格式（默认按扩展名推断）')
+    parser.add_argument('--trace-alloc', action='store_true',
+                       help='在 --metrics 中同时记录各阶段的内存分配峰值（tracemalloc，会明显拖慢计时；'
+                            '不能与 --pipeline 同时使用）')
+    parser.add_argument('--profile', type=str, default=None, metavar='PATH',
+                       help='单文件模式下保存性能剖析数据（cProfile；.html 使用 pyinstrument）')
+    parser.add_argument('--no-draft', action='store_true',
+                       help='完整解码JPEG（默认按DCT缩放直接解码到接近目标尺寸，更快、更省内存）')
+    parser.add_argument('--pipeline', action='store_true',
+                       help='目录模式下使用流水线：读取/写出线程与计算线程（--jobs 个）同时工作')
+    parser.add_argument('--io-threads', type=int, default=DEFAULT_IO_THREADS,
+                       help=f'流水线模式下读取和写出阶段各自的线程数（默认: {DEFAULT_IO_THREADS}）')
+    parser.add_argument('--recursive', '-r', action='store_true',
+                       help='目录模式下递归处理子目录')
+    parser.add_argument('--include', action='append', default=None, metavar='PATTERN',
+                       help="只处理匹配的文件（通配符，匹配相对路径或文件名，如 '2024/*' 或 '*.jpg'；可重复）")
+    parser.add_argument('--exclude', action='append', default=None, metavar='PATTERN',
+                       help='跳过匹配的文件或子目录（通配符；可重复）')
+    parser.add_argument('--output-dir', type=str, default=None, metavar='DIR',
+                       help='把输出写到该目录下，并保持与输入相同的子目录结构（默认写在输入文件旁边）')
+    parser.add_argument('--sync', action='store_true',
+                       help='目录增量同步：只转换新增或变化的文件，并删除源文件已不存在的输出')
+    parser.add_argument('--cache', action='store_true',
+                       help='使用转换缓存：输入和设置都未变化的文件直接取缓存结果')
+    parser.add_argument('--cache-dir', type=str, default=None, metavar='DIR',
+                       help='缓存根目录（默认与查找表相同，如 ~/.cache/convnew）')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE >> 20, metavar='MB',
+                       help=f'转换缓存的大小上限，超出时淘汰最久未使用的条目'
+                            f'（默认: {DEFAULT_CACHE_SIZE >> 20} MB）')
+    return parser
+
+def main(argv=None):
+    """命令行入口，返回进程退出码"""
+    # 命令行运行时不显示 PIL/numba 的警告；作为库导入时不改动宿主进程的警告设置
+    warnings.filterwarnings('ignore')
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'bench':
+        # 基准测试子命令（按需导入，避免普通转换加载额外模块）
+        from convnew import bench
+        return bench.main(argv[1:])
+    if argv and argv[0] == 'serve':
+        # 常驻转换服务子命令
+        from convnew import serve
+        return serve.main(argv[1:])
+
+    args = build_parser().parse_args(argv)
+
+    # 检查输入路径（仅测试模式允许通配符）
+    from_stdin = args.input_path == '-'
+    is_pattern = args.test_only and any(c in args.input_path for c in '*?[')
+    if not from_stdin and not is_pattern and not os.path.exists(args.input_path):
+        print(f'错误：路径 {args.input_path} 不存在')
+        return 1
+
+    try:
+        get_palette(args.palette)
+    except ValueError as e:
+        print(f'错误：{e}')
+        return 1
+
+    if args.jobs is not None and args.jobs < 1:
+        print('错误：--jobs 至少为 1')
+        return 1
+    if args.io_threads < 1:
+        print('错误：--io-threads 至少为 1')
+        return 1
+
+    # 如果是仅测试模式
+    if args.test_only:
+        return run_compatibility_tests(args)
+    if args.sync and not os.path.isdir(args.input_path):
+        print('错误：--sync 只能用于目录输入')
+        return 1
+    if args.dither_threads < 1:
+        print('错误：--dither-threads 至少为 1')
+        return 1
+    if args.dither_threads > 1 and args.pipeline:
+        # 流水线的多个计算线程同时进入 numba 并行区域时，部分线程层会直接终止进程
+        print('错误：--dither-threads 不能与 --pipeline 同时使用')
+        return 1
+    if args.trace_alloc and args.pipeline:
+        # tracemalloc 的峰值是整个进程的，并发运行的各阶段无法分开统计
+        print('错误：--trace-alloc 不能与 --pipeline 同时使用')
+        return 1
+
+    # 获取配置并应用命令行参数覆盖
+    try:
+        config = build_config(args.preset, enhance=args.enhance,
+                              contrast=args.contrast, brightness=args.brightness)
+    except ValueError as e:
+        print(f'错误：{e}')
+        return 1
+    # 指标和剖析结果在处理完成后才写出，先检查目标路径，以免转换完才发现写不出去
+    try:
+        if args.metrics:
+            check_output_path(args.metrics)
+        if args.profile:
+            check_profile_path(args.profile)
+    except ValueError as e:
+        print(f'错误：{e}')
+        return 1
+    if args.no_dither:
+        args.method = 'none'
+
+    # 处理输入
+    records = []
+    if from_stdin or os.path.isfile(args.input_path):
+        # 单文件处理
+        with profiled(args.profile):
+            ok, record = _process_with_metrics(args.input_path, args, config)
+        records.append(record)
+        if args.metrics and not _save_metrics(records, args):
+            ok = False
+        if args.cache:
+            evict(args.cache_dir, args.cache_size << 20)
+        if not ok:
+            return 1
+    elif os.path.isdir(args.input_path):
+        if args.output:
+            print('错误：--output 只能用于单个文件输入')
+            return 1
+        if args.profile:
+            print('错误：--profile 只能用于单个文件输入')
+            return 1
+        
+        # 批量处理
+        print(f'扫描目录: {args.input_path}' + ('（包括子目录）' if args.recursive else ''))
+
+        # 边遍历边处理，排除本工具之前生成的输出文件以及位于输入目录内的输出目录
+        image_files = (f for f in iter_image_files(args.input_path, recursive=args.recursive,
+                                                   include=args.include, exclude=args.exclude,
+                                                   skip_dirs=[args.output_dir] if args.output_dir else ())
+                       if not is_output_file(f))
+
+        if args.sync:
+            # 增量同步：只转换新增或变化的文件，清理源文件已删除的输出
+            # （需要完整的文件列表来找出已删除的源文件；清单写在输出根目录）
+            image_files = list(image_files)
+            manifest_dir = args.output_dir or args.input_path
+            manifest = load_manifest(manifest_dir)
+            settings_hash = settings_digest(dict(conversion_settings(args, config),
+                                                 format=args.format, preview=not args.no_preview))
+            removed = remove_stale(args.input_path, image_files, manifest)
+            total = len(image_files)
+            image_files, fingerprints = plan_sync(args.input_path, image_files, manifest,
+                                                  settings_hash)
+            print(f'同步: 共 {total} 个图片文件, 未变化 {total - len(image_files)} 个, '
+                  f'删除过期输出 {removed} 个')
+            if not image_files:
+                save_manifest(manifest_dir, manifest)
+                print('所有文件都是最新的')
+                return 0
+            print(f'找到 {len(image_files)} 个需要转换的图片文件')
+        print('-' * 60)
+
+        # 只有写指标或同步清单时才保留每个文件的记录，缓存命中只计数
+        cache_counts = {'hit': 0, 'miss': 0}
+        peak_memory = [0]
+
+        def on_record(record):
+            if record.get('cache'):
+                cache_counts[record['cache']] += 1
+            peak_memory[0] = max(peak_memory[0], record.get('peak_rss') or 0)
+            if args.metrics or args.sync:
+                records.append(record)
+
+        # 批处理
+        jobs = args.jobs or os.cpu_count() or 1
+        if args.pipeline:
+            print(f'流水线: 读取/写出线程各 {args.io_threads} 个, 计算线程 {jobs} 个')
+            success_count, count = run_pipeline(image_files, args, config,
+                                                io_threads=args.io_threads,
+                                                compute_workers=jobs, on_record=on_record)
+        else:
+            if jobs > 1:
+                print(f'并行进程数: {min(jobs, len(image_files)) if args.sync else jobs}')
+            success_count, count = process_batch(image_files, args, config, jobs=jobs,
+                                                 on_record=on_record)
+        if count == 0:
+            print(f'错误：未找到图片文件')
+            return 1
+        metrics_ok = not args.metrics or _save_metrics(records, args)
+        if args.sync:
+            # 失败的文件不写入清单，下次运行时重试
+            for record in records:
+                if record['ok']:
+                    update_entry(args.input_path, manifest, record['file'],
+                                 fingerprints[record['file']], settings_hash,
+                                 output_paths(record['file'], args))
+            save_manifest(manifest_dir, manifest)
+
+        print('\n' + '=' * 60)
+        print(f'处理完成！成功: {success_count}/{count} 个文件, '
+              f'失败: {count - success_count} 个')
+        if peak_memory[0]:
+            print(f'峰值内存（单个{"进程" if args.pipeline else "工作进程"}）: '
+                  f'{peak_memory[0] / (1 << 20):.0f} MB')
+        if args.cache:
+            evicted = evict(args.cache_dir, args.cache_size << 20)
+            print(f'转换缓存: 命中 {cache_counts["hit"]} 个, 未命中 {cache_counts["miss"]} 个'
+                  + (f', 淘汰旧条目 {evicted} 个' if evicted else ''))
+        if not metrics_ok:
+            return 1
     else:
-        print('错误：--test-only 参数需要一个BMP文件路径')
-        sys.exit(1)
-
-# 预设配置
-presets = {
-    'photo': {
-        'color_enhance': 1.5,
-        'contrast': 1.3,
-        'brightness': 1.0,
-        'sharpen': 1.2,
-        'denoise': True,
-        'auto_balance': True,
-        'edge_enhance': False,
-        'optimize_colors': False
-    },
-    'art': {
-        'color_enhance': 1.8,
-        'contrast': 1.5,
-        'brightness': 1.0,
-        'sharpen': 1.4,
-        'denoise': False,
-        'auto_balance': True,
-        'edge_enhance': False,
-        'optimize_colors': False
-    },
-    'text': {
-        'color_enhance': 1.0,
-        'contrast': 1.7,
-        'brightness': 1.1,
-        'sharpen': 1.6,
-        'denoise': False,
-        'auto_balance': True,
-        'edge_enhance': True,
-        'optimize_colors': False
-    },
-    'logo': {
-        'color_enhance': 2.0,
-        'contrast': 1.4,
-        'brightness': 1.0,
-        'sharpen': 1.3,
-        'denoise': False,
-        'auto_balance': False,
-        'edge_enhance': False,
-        'optimize_colors': False
-    }
-}
-
-# 获取配置
-config = presets[args.preset].copy()
-
-# 应用命令行参数覆盖
-if args.enhance is not None:
-    config['color_enhance'] = args.enhance
-if args.contrast is not None:
-    config['contrast'] = args.contrast
-if args.brightness is not None:
-    config['brightness'] = args.brightness
-if args.no_dither:
-    args.method = 'none'
-
-# 处理输入
-if os.path.isfile(args.input_path):
-    # 单文件处理
-    if not process_single_image(args.input_path, args, config):
-        sys.exit(1)
-elif os.path.isdir(args.input_path):
-    # 批量处理
-    print(f'扫描目录: {args.input_path}')
-    
-    # 查找图片文件
-    extensions = ['jpg', 'jpeg', 'png', 'bmp']
-    image_files = []
-    for ext in extensions:
-        for case in [ext.lower(), ext.upper()]:
-            pattern = os.path.join(args.input_path, f'*.{case}')
-            image_files.extend(glob.glob(pattern))
-    
-    image_files = sorted(set(image_files))  # 去重排序
-    
-    if not image_files:
-        print(f'错误：未找到图片文件')
-        sys.exit(1)
-    
-    print(f'找到 {len(image_files)} 个图片文件')
-    print('-' * 60)
-    
-    # 批处理
-    success_count = 0
-    for i, f in enumerate(image_files, 1):
-        print(f'\n[{i}/{len(image_files)}] ', end='')
-        if process_single_image(f, args, config):
-            success_count += 1
-    
-    print('\n' + '=' * 60)
-    print(f'处理完成！成功: {success_count}/{len(image_files)} 个文件')
-else:
-    print(f'错误：{args.input_path} 无效路径')
-    sys.exit(1)
+        print(f'错误：{args.input_path} 无效路径')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()  # PyInstaller 打包后的子进程支持
+    sys.exit(main())
@@ -0,0 +1,209 @@
+#encoding: utf-8
+"""转换流程的逐阶段计时与结构化指标输出
+
+每个文件对应一条记录（dict），stage() 把某个阶段的墙钟时间、CPU时间和
+分配的内存峰值（只在调用 start_tracing() 之后）累加到记录中。记录可以写成
+JSON Lines（每个文件一行），或汇总为 Prometheus 文本格式
+（可直接交给 node_exporter 的 textfile collector）。
+"""
+
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# 流程阶段的固定顺序（输出时按此排序）
+STAGES = ['open', 'resize', 'preprocess', 'optimize', 'quantize', 'save', 'preview', 'verify']
+
+
+def new_record(path):
+    """创建一个文件的指标记录"""
+    return {'file': path, 'ok': None, 'stages': {}}
+
+
+def start_tracing():
+    """开始跟踪内存分配（--trace-alloc，tracemalloc 会明显拖慢计时）
+
+    峰值是整个进程的，只适用于各阶段依次运行的情况，流水线模式下不要调用。
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+@contextlib.contextmanager
+def stage(record, name):
+    """记录一个阶段；record 为 None 时不做任何事"""
+    if record is None:
+        yield
+        return
+
+    tracing = tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+    if tracing:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    wall = time.perf_counter()
+    cpu = time.thread_time()  # 只统计当前线程，流水线模式下各阶段互不干扰
+    try:
+        yield
+    finally:
+        entry = record['stages'].setdefault(name, {'wall_ms': 0.0, 'cpu_ms': 0.0})
+        entry['wall_ms'] += (time.perf_counter() - wall) * 1000
+        entry['cpu_ms'] += (time.thread_time() - cpu) * 1000
+        if tracing:
+            peak = tracemalloc.get_traced_memory()[1] - base
+            entry['alloc_bytes'] = max(entry.get('alloc_bytes', 0), peak)
+
+
+def peak_rss():
+    """当前进程的峰值常驻内存（字节）；无法获取时返回 None"""
+    try:
+        import resource
+    except ImportError:  # Windows：有 psutil 时使用峰值工作集
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return getattr(psutil.Process().memory_info(), 'peak_wset', None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Linux 上单位为 KB
+
+
+def finish_record(record, ok):
+    """填写结果、总耗时和进程峰值内存，并把数值四舍五入便于阅读"""
+    record['ok'] = bool(ok)
+    record['peak_rss'] = peak_rss()
+    for entry in record['stages'].values():
+        entry['wall_ms'] = round(entry['wall_ms'], 3)
+        entry['cpu_ms'] = round(entry['cpu_ms'], 3)
+    record['total_ms'] = round(sum(e['wall_ms'] for e in record['stages'].values()), 3)
+    return record
+
+
+def _stage_order(name):
+    return (STAGES.index(name) if name in STAGES else len(STAGES), name)
+
+
+def format_jsonl(records):
+    """每个文件一行JSON"""
+    return ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(records):
+    """把所有记录汇总为 Prometheus 文本格式"""
+    wall, cpu, alloc = {}, {}, {}
+    for record in records:
+        for name, entry in record['stages'].items():
+            wall[name] = wall.get(name, 0.0) + entry['wall_ms'] / 1000
+            cpu[name] = cpu.get(name, 0.0) + entry['cpu_ms'] / 1000
+            if 'alloc_bytes' in entry:
+                alloc[name] = max(alloc.get(name, 0), entry['alloc_bytes'])
+
+    lines = []
+
+    def metric(name, kind, help_text, values):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for stage_name in sorted(values, key=_stage_order):
+            value = values[stage_name]
+            value = value if isinstance(value, int) else f'{value:.6f}'
+            lines.append(f'{name}{{stage="{_label(stage_name)}"}} {value}')
+
+    metric('convnew_stage_wall_seconds_total', 'counter',
+           'Wall-clock time spent in each pipeline stage.', wall)
+    metric('convnew_stage_cpu_seconds_total', 'counter',
+           'CPU time spent in each pipeline stage.', cpu)
+    if alloc:
+        metric('convnew_stage_alloc_peak_bytes', 'gauge',
+               'Largest per-file allocation peak of each pipeline stage.', alloc)
+
+    peaks = [record['peak_rss'] for record in records if record.get('peak_rss')]
+    if peaks:
+        lines.append('# HELP convnew_peak_rss_bytes Peak resident memory of the largest worker.')
+        lines.append('# TYPE convnew_peak_rss_bytes gauge')
+        lines.append(f'convnew_peak_rss_bytes {max(peaks)}')
+
+    ok = sum(1 for record in records if record['ok'])
+    lines.append('# HELP convnew_files_total Files processed, by result.')
+    lines.append('# TYPE convnew_files_total counter')
+    lines.append(f'convnew_files_total{{result="ok"}} {ok}')
+    lines.append(f'convnew_files_total{{result="error"}} {len(records) - ok}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_format(path, fmt=None):
+    """输出格式：显式指定，或按扩展名推断（.prom → Prometheus，否则 JSON Lines）"""
+    if fmt:
+        return fmt
+    return 'prom' if os.path.splitext(path)[1].lower() in ('.prom', '.txt') else 'jsonl'
+
+
+def check_output_path(path):
+    """检查输出文件所在的目录存在且可写，否则抛出 ValueError（在开始处理之前调用）"""
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        raise ValueError(f'目录不存在: {directory}')
+    if not os.access(directory, os.W_OK):
+        raise ValueError(f'目录不可写: {directory}')
+
+
+def check_profile_path(path):
+    """检查剖析结果可以写出：目录可写，.html 还需要 pyinstrument；否则抛出 ValueError"""
+    check_output_path(path)
+    if path.lower().endswith('.html'):
+        try:
+            import pyinstrument  # noqa: F401
+        except ImportError:
+            raise ValueError('生成HTML剖析报告需要安装 pyinstrument') from None
+
+
+def write_metrics(records, path, fmt=None):
+    """写出指标文件（Prometheus 格式先写临时文件再替换，避免采集到半个文件）"""
+    fmt = metrics_format(path, fmt)
+    text = format_prometheus(records) if fmt == 'prom' else format_jsonl(records)
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def profiled(path):
+    """对代码块做性能剖析：.html 使用 pyinstrument（可选依赖），其他扩展名写出 cProfile 数据"""
+    if path is None:
+        yield
+        return
+
+    if path.lower().endswith('.html'):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise RuntimeError('生成HTML剖析报告需要安装 pyinstrument')
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(profiler.output_html())
+        return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
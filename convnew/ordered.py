@@ -0,0 +1,178 @@
+#encoding: utf-8
+"""有序抖动：阈值图（Bayer 4/8/16、蓝噪声）与调色板感知的 Knoll 图案抖动
+
+阈值图是 n×n 的秩矩阵（0..n²-1），按名称生成一次后缓存。整帧在一次向量化计算中
+完成：阈值图平铺到帧大小，与像素相加后查表量化，没有逐像素的循环。
+"""
+
+import numpy as np
+
+from convnew.lut import palette_indices
+
+# 可用的阈值图：名称 → 边长
+THRESHOLD_MAPS = {
+    'bayer4': 4,
+    'bayer8': 8,
+    'bayer16': 16,
+    'bluenoise': 64,
+}
+
+# 蓝噪声（void-and-cluster）的高斯核标准差与随机种子；结果是确定的
+BLUE_NOISE_SIGMA = 1.5
+BLUE_NOISE_SEED = 0
+
+# Knoll 图案抖动：每种颜色的候选数，以及累计误差的系数
+KNOLL_CANDIDATES = 16
+KNOLL_ERROR_MULTIPLIER = 1.0
+
+# Knoll 计划表的网格：每个通道 64 级（0..255 映射到最近的网格点）
+KNOLL_GRID = 64
+
+# 已生成的阈值图和 Knoll 计划表
+_maps = {}
+_plans = {}
+
+
+def bayer_matrix(size):
+    """size×size 的 Bayer 秩矩阵（size 为 2 的幂），值为 0..size²-1"""
+    matrix = np.zeros((1, 1), dtype=np.int64)
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2],
+                           [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+
+def blue_noise_matrix(size, sigma=BLUE_NOISE_SIGMA, seed=BLUE_NOISE_SEED):
+    """用 void-and-cluster 算法（Ulichney 1993）生成 size×size 的蓝噪声秩矩阵
+
+    能量为环形高斯滤波后的点密度；每次加入或移除一个点时只累加一个平移后的核。
+    从最稀疏处（能量最低的空位）依次加点即得到后半部分的秩，因为"补集中最密的
+    簇"与"原图案中最大的空洞"是同一个位置。
+    """
+    n = size * size
+    distance = np.minimum(np.arange(size), size - np.arange(size))
+    kernel = np.exp(-(distance[:, None] ** 2 + distance[None, :] ** 2) / (2 * sigma ** 2))
+    kernels = np.fft.rfft2(kernel)
+
+    def update(energy, position, sign):
+        y, x = divmod(position, size)
+        energy += sign * np.roll(kernel, (y, x), axis=(0, 1)).ravel()
+
+    # 初始图案：随机 10% 的点，反复把最密簇的点移到最大空洞，直到稳定
+    rng = np.random.default_rng(seed)
+    pattern = np.zeros(n, dtype=bool)
+    pattern[rng.choice(n, n // 10, replace=False)] = True
+    energy = np.fft.irfft2(np.fft.rfft2(pattern.reshape(size, size)) * kernels, s=(size, size)).ravel()
+    while True:
+        cluster = int(np.argmax(np.where(pattern, energy, -np.inf)))
+        pattern[cluster] = False
+        update(energy, cluster, -1)
+        void = int(np.argmin(np.where(pattern, np.inf, energy)))
+        pattern[void] = True
+        update(energy, void, 1)
+        if void == cluster:
+            break
+
+    ranks = np.zeros(n, dtype=np.int64)
+    ones = int(pattern.sum())
+
+    # 初始点：依次移除最密簇的点，秩从 ones-1 递减到 0
+    points, points_energy = pattern.copy(), energy.copy()
+    for rank in range(ones - 1, -1, -1):
+        cluster = int(np.argmax(np.where(points, points_energy, -np.inf)))
+        points[cluster] = False
+        update(points_energy, cluster, -1)
+        ranks[cluster] = rank
+
+    # 其余位置：依次填入最大空洞
+    for rank in range(ones, n):
+        void = int(np.argmin(np.where(pattern, np.inf, energy)))
+        pattern[void] = True
+        update(energy, void, 1)
+        ranks[void] = rank
+    return ranks.reshape(size, size)
+
+
+def threshold_map(name):
+    """按名称获取阈值秩矩阵（见 THRESHOLD_MAPS），首次使用时生成并缓存"""
+    if name not in THRESHOLD_MAPS:
+        raise ValueError(f'未知的阈值图: {name}（可选: {", ".join(THRESHOLD_MAPS)}）')
+    matrix = _maps.get(name)
+    if matrix is None:
+        size = THRESHOLD_MAPS[name]
+        matrix = blue_noise_matrix(size) if name == 'bluenoise' else bayer_matrix(size)
+        matrix.setflags(write=False)
+        _maps[name] = matrix
+    return matrix
+
+
+def tile_map(matrix, height, width):
+    """把阈值矩阵平铺到 height×width"""
+    size = matrix.shape[0]
+    return np.tile(matrix, (-(-height // size), -(-width // size)))[:height, :width]
+
+
+def ordered_indices(img_array, colors, threshold='bayer4', metric='rgb'):
+    """有序抖动，返回 (H, W) uint8 调色板索引平面
+
+    img_array 也可以是 (N, H, W, 3) 的一批同尺寸帧，此时整批一次计算，返回 (N, H, W)。
+    每个像素加上 floor(秩 * 256 / 级数) - 128（bayer4 即原先的 秩*16 - 128），
+    截断到 0..255 后查表量化。像素是整数，因此整帧都用整数运算，与原先
+    float32 相加再截断为 uint8 的结果完全相同。
+    """
+    matrix = threshold_map(threshold)
+    offsets = (matrix * 256 // matrix.size - 128).astype(np.int16)
+    height, width = img_array.shape[-3:-1]
+    dithered = np.asarray(img_array, dtype=np.int16) + tile_map(offsets, height, width)[:, :, np.newaxis]
+    return palette_indices(np.clip(dithered, 0, 255).astype(np.uint8), colors, metric)
+
+
+def knoll_plans(colors, metric='rgb'):
+    """Knoll 图案抖动的计划表：(KNOLL_GRID³, KNOLL_CANDIDATES) uint8
+
+    对网格上的每种颜色，依次选出 KNOLL_CANDIDATES 个调色板颜色，每次都匹配
+    "原色 + 系数 × 累计误差"，使这些候选的平均值逼近原色；候选按亮度排序后，
+    由阈值图的秩选择其中之一。整张表一次向量化计算，按 (调色板, 度量) 缓存。
+    """
+    colors = np.ascontiguousarray(colors, dtype=np.float32)
+    key = (colors.tobytes(), metric)
+    plans = _plans.get(key)
+    if plans is not None:
+        return plans
+
+    levels = np.round(np.arange(KNOLL_GRID) * 255 / (KNOLL_GRID - 1)).astype(np.float32)
+    grid = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+    error = np.zeros_like(grid)
+    candidates = np.empty((grid.shape[0], KNOLL_CANDIDATES), dtype=np.uint8)
+    for i in range(KNOLL_CANDIDATES):
+        attempt = np.clip(grid + error * KNOLL_ERROR_MULTIPLIER, 0, 255)
+        chosen = palette_indices((attempt + 0.5).astype(np.uint8), colors, metric)
+        candidates[:, i] = chosen
+        error += grid - colors[chosen]
+
+    # 按亮度排序：先换成亮度名次，排序后再换回调色板索引
+    by_luma = np.argsort(colors @ np.array([0.299, 0.587, 0.114], dtype=np.float32), kind='stable')
+    luma_rank = np.empty_like(by_luma)
+    luma_rank[by_luma] = np.arange(len(by_luma))
+    plans = by_luma[np.sort(luma_rank[candidates], axis=1)].astype(np.uint8)
+    _plans[key] = plans
+    return plans
+
+
+def knoll_indices(img_array, colors, threshold='bayer4', metric='rgb'):
+    """调色板感知的有序抖动（Knoll / Yliluoma 图案抖动），返回 (H, W) uint8 调色板索引平面
+
+    与在像素上叠加固定噪声不同，每种颜色对应一组候选调色板颜色，其平均值逼近
+    原色，阈值图决定每个位置取哪一个，因此调色板颜色间距不均匀时色调也更准确。
+    颜色按每通道 KNOLL_GRID 级的网格查计划表。img_array 也可以是 (N, H, W, 3) 的一批帧。
+    """
+    plans = knoll_plans(colors, metric)
+    matrix = threshold_map(threshold)
+    height, width = img_array.shape[-3:-1]
+    ranks = tile_map(matrix * KNOLL_CANDIDATES // matrix.size, height, width)
+
+    # 0..255 → 最近网格点的编号
+    grid_index = ((np.arange(256) * (KNOLL_GRID - 1) + 127) // 255).astype(np.intp)
+    cells = grid_index[np.asarray(img_array, dtype=np.uint8)]
+    cells = (cells[..., 0] * KNOLL_GRID + cells[..., 1]) * KNOLL_GRID + cells[..., 2]
+    return plans[cells, ranks]
@@ -0,0 +1,173 @@
+#encoding: utf-8
+"""调色板：固件调色板、实测的面板颜色，以及从 JSON/GPL 文件加载的自定义调色板
+
+每个调色板区分两组颜色，顺序相同、与面板颜色编码一一对应：
+- match：匹配和误差扩散使用的颜色，应为面板实际显示的颜色（例如实测值）；
+- output：写入 BMP 和预览的颜色，固件按这些 RGB 值识别颜色，因此通常就是
+  面板的固件颜色。
+调色板以字典表示：{'name', 'panel', 'match', 'output', 'codes', 'key'}，
+key 是三组数据的哈希，查找表、PIL 调色板图像等派生数据都按它缓存。
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# E Ink E6 标准6色定义
+E6_COLORS = np.array([
+    [0, 0, 0],        # 黑色
+    [255, 255, 255],  # 白色
+    [255, 255, 0],    # 黄色
+    [255, 0, 0],      # 红色
+    [0, 0, 255],      # 蓝色
+    [0, 255, 0]       # 绿色
+], dtype=np.float32)
+
+# 7色（E7/7C）固件颜色定义：黑、白、黄、红、蓝、绿、橙
+# 与 backup/GUI_BMPfile_7c.c 的判断保持一致（RGB: Orange = 255,128,0）
+E7_COLORS = np.array([
+    [0, 0, 0],        # 黑色
+    [255, 255, 255],  # 白色
+    [255, 255, 0],    # 黄色
+    [255, 0, 0],      # 红色
+    [0, 0, 255],      # 蓝色
+    [0, 255, 0],      # 绿色
+    [255, 128, 0],    # 橙色
+], dtype=np.float32)
+
+# 实测的 E6 面板颜色（与 analyze_outputs.py 相同），顺序同 E6_COLORS
+E6_MEASURED_COLORS = np.array([
+    [0, 0, 0],        # 黑色
+    [255, 255, 255],  # 白色
+    [255, 243, 56],   # 黄色
+    [191, 0, 0],      # 红色
+    [100, 64, 255],   # 蓝色
+    [67, 138, 28]     # 绿色
+], dtype=np.float32)
+
+# 固件颜色编码（Paint_SetPixel 的 color 值），按 E6_COLORS / E7_COLORS 的顺序
+# 与 backup/GUI_BMPfile.c（E6，4为跳过位）和 GUI_BMPfile_7c.c（E7）保持一致
+E6_PANEL_CODES = np.array([0, 1, 2, 3, 5, 6], dtype=np.uint8)
+E7_PANEL_CODES = np.array([0, 1, 5, 4, 3, 2, 6], dtype=np.uint8)
+
+# 面板：固件颜色与颜色编码
+PANELS = {
+    'e6': (E6_COLORS, E6_PANEL_CODES),
+    'e7': (E7_COLORS, E7_PANEL_CODES),
+}
+
+# 内置调色板：名称 → (面板, 匹配颜色)
+BUILTIN_PALETTES = {
+    'e6': ('e6', E6_COLORS),
+    'e7': ('e7', E7_COLORS),
+    'e6-measured': ('e6', E6_MEASURED_COLORS),
+}
+
+PALETTE_FILE_EXTENSIONS = ('.json', '.gpl')
+
+# 已加载的调色板：内置名称或 (路径, mtime, 大小) → 调色板
+_loaded = {}
+
+
+def _color_array(colors, count, what):
+    colors = np.asarray(colors, dtype=np.float64)
+    if colors.shape != (count, 3):
+        raise ValueError(f'{what}应为 {count} 个 RGB 颜色，实际形状为 {colors.shape}')
+    if np.any(colors < 0) or np.any(colors > 255) or np.any(colors != np.round(colors)):
+        raise ValueError(f'{what}的分量必须是 0..255 的整数')
+    return colors.astype(np.float32)
+
+
+def make_palette(panel, match=None, output=None, name=None):
+    """构造调色板；match、output 省略时使用面板的固件颜色"""
+    if panel not in PANELS:
+        raise ValueError(f'未知的面板: {panel}（可选: {", ".join(PANELS)}）')
+    firmware, codes = PANELS[panel]
+    count = len(firmware)
+    match = firmware if match is None else _color_array(match, count, '匹配颜色')
+    output = firmware if output is None else _color_array(output, count, '输出颜色')
+
+    digest = hashlib.sha256(panel.encode('ascii'))
+    for array in (match, output, codes):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return {'name': name or panel, 'panel': panel, 'match': match, 'output': output,
+            'codes': codes, 'key': digest.hexdigest()[:16]}
+
+
+def parse_gpl(text):
+    """解析 GIMP 调色板（.gpl），返回 (名称, [[r, g, b], ...])"""
+    lines = text.splitlines()
+    if not lines or lines[0].strip() != 'GIMP Palette':
+        raise ValueError('不是 GIMP 调色板文件（第一行应为 "GIMP Palette"）')
+    name, colors = None, []
+    for line in lines[1:]:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('Name:'):
+            name = line[5:].strip()
+            continue
+        if line.startswith('Columns:'):
+            continue
+        fields = line.split()
+        try:
+            colors.append([int(v) for v in fields[:3]])
+        except ValueError:
+            raise ValueError(f'无法解析调色板行: {line}') from None
+    return name, colors
+
+
+def load_palette_file(path):
+    """从 JSON 或 GPL 文件加载调色板
+
+    JSON：{"panel": "e6", "name": ..., "match": [[r, g, b], ...], "output": [...]}，
+    match 和 output 都可省略（默认为固件颜色）。
+    GPL：颜色即匹配颜色，面板按颜色数确定（6 色为 E6，7 色为 E7）。
+    颜色顺序与固件调色板相同（黑、白、黄、红、蓝、绿[、橙]）。
+    """
+    default_name = os.path.splitext(os.path.basename(path))[0]
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    if path.lower().endswith('.gpl'):
+        name, colors = parse_gpl(text)
+        panel = {len(c): p for p, (c, _) in PANELS.items()}.get(len(colors))
+        if panel is None:
+            raise ValueError(f'{path}: 调色板有 {len(colors)} 个颜色，'
+                             f'应为 {" 或 ".join(str(len(c)) for c, _ in PANELS.values())} 个')
+        return make_palette(panel, match=colors, name=name or default_name)
+
+    data = json.loads(text)
+    if not isinstance(data, dict) or 'panel' not in data:
+        raise ValueError(f'{path}: JSON 调色板必须是包含 "panel" 的对象')
+    return make_palette(data['panel'], match=data.get('match'), output=data.get('output'),
+                        name=data.get('name') or default_name)
+
+
+def get_palette(palette):
+    """按名称或文件路径获取调色板（已是调色板字典时原样返回）
+
+    内置名称见 BUILTIN_PALETTES；文件按路径、修改时间和大小缓存，文件变化后重新加载。
+    """
+    if isinstance(palette, dict):
+        return palette
+    if palette in BUILTIN_PALETTES:
+        loaded = _loaded.get(palette)
+        if loaded is None:
+            panel, match = BUILTIN_PALETTES[palette]
+            loaded = _loaded[palette] = make_palette(panel, match, name=palette)
+        return loaded
+
+    if not palette.lower().endswith(PALETTE_FILE_EXTENSIONS):
+        raise ValueError(f'未知的调色板: {palette}（可选: {", ".join(BUILTIN_PALETTES)}，'
+                         f'或 .json/.gpl 调色板文件）')
+    try:
+        st = os.stat(palette)
+    except OSError:
+        raise ValueError(f'调色板文件 {palette} 不存在') from None
+    key = (os.path.realpath(palette), st.st_mtime_ns, st.st_size)
+    loaded = _loaded.get(key)
+    if loaded is None:
+        loaded = _loaded[key] = load_palette_file(palette)
+    return loaded
@@ -0,0 +1,131 @@
+#encoding: utf-8
+"""流水线批处理：读取解码、计算和写出在不同线程中重叠进行
+
+   路径 → [读取线程] → 解码队列 → [计算线程] → 写出队列 → [写出线程] → 主线程汇总
+
+读取阶段读入文件并解码（网络共享上主要是等待I/O），计算阶段缩放、预处理并
+抖动，写出阶段编码、写文件、保存预览并做兼容性测试。各阶段之间是有界队列，
+内存中同时存在的图像数量有上限，磁盘和CPU可以同时忙碌。
+计算阶段也使用线程：numba 内核不持有GIL（nogil），Pillow 的缩放和滤镜、
+NumPy 的大数组运算也会释放GIL，因此多个计算线程可以真正并行。
+"""
+
+import os
+import queue
+import threading
+
+from convnew.metrics import new_record, finish_record
+from convnew.palette import get_palette
+
+# 放在队列中表示上游已经结束
+_DONE = object()
+
+DEFAULT_IO_THREADS = 2
+
+
+def _stage_workers(count, work, inbox, outbox, downstream):
+    """启动一个阶段的 count 个线程；最后一个退出的线程向下游发送 downstream 个结束标记"""
+    remaining = [count]
+    lock = threading.Lock()
+
+    def run():
+        while True:
+            job = inbox.get()
+            if job is _DONE:
+                break
+            if job['error'] is None:
+                try:
+                    work(job)
+                except Exception as e:
+                    job['error'] = e
+            outbox.put(job)
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(downstream):
+                outbox.put(_DONE)
+
+    threads = [threading.Thread(target=run, daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def run_pipeline(image_files, args, config, io_threads=DEFAULT_IO_THREADS,
+                 compute_workers=None, queue_size=None, on_record=None):
+    """以流水线方式处理文件，返回 (成功的文件数, 处理的文件数)
+
+    image_files 可以是列表或迭代器；queue_size 为每个队列的容量（默认为计算线程数的2倍）。
+    每个文件的日志在完成后整段输出；on_record 为每个文件的指标记录调用一次。
+    """
+    # 在函数内导入以避免循环导入（main 在模块级导入本模块）
+    from convnew.main import read_input, compute_indices, write_outputs
+
+    if compute_workers is None:
+        compute_workers = os.cpu_count() or 1
+    if queue_size is None:
+        queue_size = 2 * compute_workers
+    # 线程数为0的阶段不会发送结束标记，主线程会一直等待
+    if io_threads < 1 or compute_workers < 1 or queue_size < 1:
+        raise ValueError('io_threads、compute_workers 和 queue_size 都至少为 1')
+
+    paths = queue.Queue(queue_size)
+    decoded = queue.Queue(queue_size)
+    computed = queue.Queue(queue_size)
+    finished = queue.Queue()
+
+    def read(job):
+        log = job['lines'].append
+        log(f'\n处理图像: {job["file"]}')
+        log(f'预设: {args.preset}, 抖动: {args.method}, '
+            f'调色板: {get_palette(args.palette)["name"].upper()}')
+        if not os.path.isfile(job['file']):
+            raise FileNotFoundError(f'文件 {job["file"]} 不存在')
+        job['image'], job['indices'], job['key'] = read_input(
+            job['file'], args, config, job['record'], log=log)
+
+    def compute(job):
+        if job['indices'] is None:
+            job['indices'] = compute_indices(job.pop('image'), args, config, job['key'],
+                                             job['record'], log=job['lines'].append)
+
+    def write(job):
+        write_outputs(job['file'], job.pop('indices'), args, job['record'],
+                      log=job['lines'].append)
+
+    threads = (_stage_workers(io_threads, read, paths, decoded, compute_workers)
+               + _stage_workers(compute_workers, compute, decoded, computed, io_threads)
+               + _stage_workers(io_threads, write, computed, finished, 1))
+
+    # 路径由单独的线程送入，主线程只负责按完成顺序输出
+    def feed():
+        try:
+            for path in image_files:
+                paths.put({'file': path, 'record': new_record(path), 'lines': [], 'error': None})
+        finally:  # 遍历出错时也要让下游线程结束
+            for _ in range(io_threads):
+                paths.put(_DONE)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    success_count = count = 0
+    while True:
+        job = finished.get()
+        if job is _DONE:
+            break
+        count += 1
+        ok = job['error'] is None
+        if not ok:
+            job['lines'].append(f'✗ 处理 {job["file"]} 时出错: {str(job["error"])}')
+        print(f'\n[{count}] ' + '\n'.join(job['lines']), flush=True)
+        if on_record is not None:
+            on_record(finish_record(job['record'], ok))
+        if ok:
+            success_count += 1
+
+    feeder.join()
+    for thread in threads:
+        thread.join()
+    return success_count, count
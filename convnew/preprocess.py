@@ -0,0 +1,381 @@
+#encoding: utf-8
+"""融合的预处理引擎
+
+preprocess_image 依次调用最多七个 PIL 操作，每一步都生成一幅新图像。这里把它们
+合并为最多四次遍历，结果与 PIL 链逐字节相同：
+1. 中值滤波（denoise）。autocontrast 是逐通道单调的查找表，与中值滤波可交换，
+   因此直接在原始图像上做中值滤波，查找表留到下一步。
+2. 点运算：autocontrast 查找表 → Color（与灰度图混合，跨通道）→ Contrast 和
+   Brightness。后两者是逐通道的，合并为一个 256 项的查找表，一次遍历完成。
+   Contrast 需要 Color 之后的灰度均值，此时先遍历一次求均值，再原地查表。
+3. Sharpness：SMOOTH 卷积后与原图混合，一次 3x3 遍历。
+4. EDGE_ENHANCE：一次 3x3 遍历。
+
+PIL 在每一步之后都取整为 uint8，中间结果也保存为 uint8；每一步内部的运算与 PIL
+相同（float32，卷积四舍五入，混合向零截断，3x3 滤波的边缘像素保持不变）。
+有 numba 时使用编译内核，否则使用 NumPy 实现（中值滤波仍交给 PIL）。
+"""
+
+import math
+import sys
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:  # numba 为可选依赖
+    njit = None
+    HAVE_NUMBA = False
+
+# ImageFilter.SMOOTH（Sharpness 的退化图像）与 ImageFilter.EDGE_ENHANCE 的卷积核，
+# 与 PIL 一样先除以 scale 再转为 float32
+SMOOTH_KERNEL = (np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32)
+                 / np.float32(13))
+EDGE_ENHANCE_KERNEL = (np.array([[-1, -1, -1], [-1, 10, -1], [-1, -1, -1]], dtype=np.float32)
+                       / np.float32(2))
+
+IDENTITY_LUT = np.arange(256, dtype=np.uint8)
+
+# optimize_colors：通道差超过 STRONG_COLOR_SPREAD 的像素增强主导通道、减弱其余通道
+STRONG_COLOR_SPREAD = 80
+ENHANCE_FACTOR = np.float32(1.2)
+REDUCE_FACTOR = np.float32(0.85)
+
+# NumPy 实现每次处理的行数，临时数组的大小与之成正比
+OPTIMIZE_BLOCK_ROWS = 64
+
+# 色彩、对比度、亮度系数的允许范围（含端点）
+FACTOR_RANGE = (0.0, 10.0)
+FACTOR_KEYS = ('color_enhance', 'contrast', 'brightness')
+
+
+def channel_histograms(pixels):
+    """各通道的直方图，返回 (3, 256)"""
+    flat = np.asarray(pixels, dtype=np.uint8).reshape(-1, 3)
+    offsets = np.array([0, 256, 512], dtype=np.uint16)
+    return np.bincount((flat + offsets).ravel(), minlength=768).reshape(3, 256)
+
+
+def autocontrast_lut(hist, cutoff=2):
+    """与 ImageOps.autocontrast(cutoff=cutoff) 相同的逐通道查找表，返回 (3, 256) uint8"""
+    lut = np.empty((3, 256), dtype=np.uint8)
+    levels = np.arange(256, dtype=np.float64)
+    for c in range(3):
+        cut = int(hist[c].sum() * cutoff // 100)
+        # 去掉两端各 cutoff% 的像素后，剩余像素的最小和最大值
+        lo = int(np.argmax(np.cumsum(hist[c]) > cut))
+        hi = 255 - int(np.argmax(np.cumsum(hist[c][::-1]) > cut))
+        if hi <= lo:
+            lut[c] = IDENTITY_LUT
+        else:
+            scale = 255.0 / (hi - lo)
+            lut[c] = np.clip(np.trunc(levels * scale - lo * scale), 0, 255)
+    return lut
+
+
+def check_factors(config):
+    """检查配置中的色彩、对比度、亮度系数，非有限值或超出 FACTOR_RANGE 时抛出 ValueError"""
+    lo, hi = FACTOR_RANGE
+    for key in FACTOR_KEYS:
+        value = config.get(key, 1.0)
+        if not math.isfinite(value) or not lo <= value <= hi:
+            raise ValueError(f'{key} 系数必须是 {lo:g} 到 {hi:g} 之间的有限数值: {value}')
+
+
+def _blend(base, image, factor):
+    """Image.blend(base, image, factor)：float32 运算，截断并限制到 [0, 255]"""
+    image = np.asarray(image, dtype=np.float32)
+    value = np.float32(base) + np.float32(factor) * (image - np.float32(base))
+    return np.clip(value, 0, 255).astype(np.uint8)
+
+
+def level_lut(contrast=1.0, brightness=1.0, mean=0):
+    """Contrast（以灰度均值 mean 为退化图像）和 Brightness 合并的查找表"""
+    lut = IDENTITY_LUT
+    if contrast != 1.0:
+        lut = _blend(mean, lut.astype(np.int32), contrast)
+    if brightness != 1.0:
+        lut = _blend(0, lut.astype(np.int32), brightness)
+    return lut
+
+
+def _histograms_python(src, hist):
+    """各通道的直方图累加到 hist (3, 256)"""
+    flat = src.reshape(-1)
+    for i in range(0, flat.shape[0], 3):
+        hist[0, flat[i]] += 1
+        hist[1, flat[i + 1]] += 1
+        hist[2, flat[i + 2]] += 1
+
+
+def _median3x3_python(src, out):
+    """3x3 中值滤波（复制边界），逐通道
+
+    先把每列的三个值排序，九个值的中值等于
+    med3(各列最小值中的最大者, 各列中值的中值, 各列最大值中的最小者)。
+    每行按 (W*3,) 展平处理，左右相邻像素相距3个元素。
+    """
+    height, width = src.shape[0], src.shape[1]
+    n = width * 3
+    rows = src.reshape(height, n)
+    dst = out.reshape(height, n)
+    # 左右各多一个像素（复制边界）
+    lo = np.empty(n + 6, dtype=np.uint8)
+    mid = np.empty(n + 6, dtype=np.uint8)
+    hi = np.empty(n + 6, dtype=np.uint8)
+    for y in range(height):
+        up, row, down = rows[max(y - 1, 0)], rows[y], rows[min(y + 1, height - 1)]
+        for i in range(n):
+            a, b, d = up[i], row[i], down[i]
+            a, b = min(a, b), max(a, b)
+            b, d = min(b, d), max(b, d)
+            a, b = min(a, b), max(a, b)
+            lo[i + 3], mid[i + 3], hi[i + 3] = a, b, d
+        for c in range(3):
+            lo[c], mid[c], hi[c] = lo[c + 3], mid[c + 3], hi[c + 3]
+            lo[n + 3 + c], mid[n + 3 + c], hi[n + 3 + c] = lo[n + c], mid[n + c], hi[n + c]
+        line = dst[y]
+        for i in range(n):
+            a = max(max(lo[i], lo[i + 3]), lo[i + 6])
+            d = min(min(hi[i], hi[i + 3]), hi[i + 6])
+            b0, b1, b2 = mid[i], mid[i + 3], mid[i + 6]
+            b = max(min(b0, b1), min(max(b0, b1), b2))
+            line[i] = max(min(a, b), min(max(a, b), d))
+
+
+def _point_python(src, lut, color, levels, out):
+    """查找表 → Color 混合 → 第二个查找表，写入 out（可以与 src 相同）
+
+    返回 out 的灰度之和（Contrast 求均值用）。
+    """
+    pixels = src.reshape(-1, 3)
+    dst = out.reshape(-1, 3)
+    zero, top = np.float32(0), np.float32(255)
+    total = 0
+    for i in range(pixels.shape[0]):
+        r = np.int32(lut[0, pixels[i, 0]])
+        g = np.int32(lut[1, pixels[i, 1]])
+        b = np.int32(lut[2, pixels[i, 2]])
+        if color != 1.0:
+            base = np.float32((19595 * r + 38470 * g + 7471 * b + 32768) >> 16)
+            r = np.int32(min(max(base + color * (np.float32(r) - base), zero), top))
+            g = np.int32(min(max(base + color * (np.float32(g) - base), zero), top))
+            b = np.int32(min(max(base + color * (np.float32(b) - base), zero), top))
+            # 编译内核不检查下标；限制到 0..255 后再查表
+            r, g, b = min(max(r, 0), 255), min(max(g, 0), 255), min(max(b, 0), 255)
+        r, g, b = np.int32(levels[r]), np.int32(levels[g]), np.int32(levels[b])
+        dst[i, 0], dst[i, 1], dst[i, 2] = r, g, b
+        total += (19595 * r + 38470 * g + 7471 * b + 32768) >> 16
+    return total
+
+
+def _filter3x3_python(src, kernel, factor, out):
+    """3x3 卷积（四舍五入）后与原图混合：Image.blend(卷积结果, src, factor)
+
+    factor 为 0 时就是卷积结果。与 PIL 一样，边缘一圈像素保持不变。
+    """
+    height, width = src.shape[0], src.shape[1]
+    n = width * 3
+    rows = src.reshape(height, n)
+    dst = out.reshape(height, n)
+    k00, k01, k02 = kernel[0, 0], kernel[0, 1], kernel[0, 2]
+    k10, k11, k12 = kernel[1, 0], kernel[1, 1], kernel[1, 2]
+    k20, k21, k22 = kernel[2, 0], kernel[2, 1], kernel[2, 2]
+    zero, half, top = np.float32(0), np.float32(0.5), np.float32(255)
+    dst[0] = rows[0]
+    dst[height - 1] = rows[height - 1]
+    for y in range(1, height - 1):
+        up, row, down, line = rows[y - 1], rows[y], rows[y + 1], dst[y]
+        for i in range(3):
+            line[i] = row[i]
+            line[n - 3 + i] = row[n - 3 + i]
+        for i in range(3, n - 3):
+            acc = (k00 * np.float32(up[i - 3]) + k01 * np.float32(up[i]) + k02 * np.float32(up[i + 3])
+                   + k10 * np.float32(row[i - 3]) + k11 * np.float32(row[i])
+                   + k12 * np.float32(row[i + 3])
+                   + k20 * np.float32(down[i - 3]) + k21 * np.float32(down[i])
+                   + k22 * np.float32(down[i + 3]))
+            # 截断前先限制范围，非负数的截断即向下取整
+            base = np.float32(np.int32(min(max(acc + half, zero), top)))
+            if factor != 0:
+                base = np.float32(np.int32(min(max(base + factor * (np.float32(row[i]) - base),
+                                                   zero), top)))
+            line[i] = np.uint8(base)
+
+
+def _optimize_colors_python(src, out):
+    """optimize_colors 的逐像素实现（float32 运算），out 可以与 src 相同"""
+    pixels = src.reshape(-1, 3)
+    dst = out.reshape(-1, 3)
+    enhance, reduce = ENHANCE_FACTOR, REDUCE_FACTOR
+    zero, top = np.float32(0), np.float32(255)
+    for i in range(pixels.shape[0]):
+        r, g, b = np.float32(pixels[i, 0]), np.float32(pixels[i, 1]), np.float32(pixels[i, 2])
+        high = max(max(r, g), b)
+        if high - min(min(r, g), b) > STRONG_COLOR_SPREAD:
+            # 主导通道增强，另外两个通道减弱；并列时依次为红、绿、蓝
+            if r == high:
+                r, g, b = min(top, r * enhance), g * reduce, b * reduce
+            elif g == high:
+                r, g, b = r * reduce, min(top, g * enhance), b * reduce
+            else:
+                r, g, b = r * reduce, g * reduce, min(top, b * enhance)
+        # 接近纯色的像素直接设为纯色，按黄、红、绿、蓝的顺序依次判断
+        if r > 200 and g > 200 and b < 50:
+            r, g, b = top, top, zero
+        if r > 200 and g < 100 and b < 100:
+            r, g, b = top, zero, zero
+        if r < 100 and g > 200 and b < 100:
+            r, g, b = zero, top, zero
+        if r < 100 and g < 100 and b > 200:
+            r, g, b = zero, zero, top
+        dst[i, 0], dst[i, 1], dst[i, 2] = np.uint8(r), np.uint8(g), np.uint8(b)
+
+
+if HAVE_NUMBA:
+    _jit = njit(cache=not getattr(sys, 'frozen', False), nogil=True)
+    _histograms_compiled = _jit(_histograms_python)
+    _median3x3_compiled = _jit(_median3x3_python)
+    _point_compiled = _jit(_point_python)
+    _filter3x3_compiled = _jit(_filter3x3_python)
+    _optimize_colors_compiled = _jit(_optimize_colors_python)
+else:
+    _histograms_compiled = _median3x3_compiled = _point_compiled = _filter3x3_compiled = None
+    _optimize_colors_compiled = None
+
+
+def _median3x3_numpy(src, out):
+    out[:] = np.asarray(Image.fromarray(src).filter(ImageFilter.MedianFilter(size=3)))
+
+
+def _point_numpy(src, lut, color, levels, out):
+    """NumPy 实现，与 _point_python 相同"""
+    pixels = np.stack([lut[c][src[..., c]] for c in range(3)], axis=-1)
+    if color != 1.0:
+        wide = pixels.astype(np.int32)
+        gray = (19595 * wide[..., 0] + 38470 * wide[..., 1] + 7471 * wide[..., 2] + 32768) >> 16
+        pixels = _blend(gray[..., None], wide, color)
+    out[:] = levels[pixels]
+    wide = out.astype(np.int32)
+    gray = (19595 * wide[..., 0] + 38470 * wide[..., 1] + 7471 * wide[..., 2] + 32768) >> 16
+    return int(gray.sum(dtype=np.int64))
+
+
+def _filter3x3_numpy(src, kernel, factor, out):
+    """NumPy 实现，与 _filter3x3_python 相同"""
+    height, width = src.shape[:2]
+    acc = np.zeros((height - 2, width - 2, 3), dtype=np.float32)
+    for ky in range(3):
+        for kx in range(3):
+            acc += kernel[ky, kx] * src[ky:ky + height - 2, kx:kx + width - 2].astype(np.float32)
+    acc += np.float32(0.5)
+    filtered = np.clip(acc, 0, 255).astype(np.uint8)
+    out[:] = src
+    inner = src[1:-1, 1:-1]
+    out[1:-1, 1:-1] = _blend(filtered, inner, factor) if factor != 0 else filtered
+
+
+def preprocess_array(img_array, config, engine=None):
+    """融合预处理，输入输出都是 (H, W, 3) uint8 数组，结果与 preprocess_image 相同
+
+    engine: None 自动选择；'numba' 编译内核；'numpy' NumPy 实现
+    """
+    if engine is None:
+        engine = 'numba' if HAVE_NUMBA else 'numpy'
+    if engine == 'numba' and not HAVE_NUMBA:
+        raise RuntimeError('未安装 numba，无法使用编译内核')
+    check_factors(config)
+    if engine == 'numba':
+        median, point, filter3x3 = _median3x3_compiled, _point_compiled, _filter3x3_compiled
+    else:
+        median, point, filter3x3 = _median3x3_numpy, _point_numpy, _filter3x3_numpy
+
+    src = np.ascontiguousarray(img_array, dtype=np.uint8)
+    height, width = src.shape[:2]
+    # autocontrast 的直方图取自原图（中值滤波之前）
+    if config.get('auto_balance', True):
+        if engine == 'numba':
+            hist = np.zeros((3, 256), dtype=np.int64)
+            _histograms_compiled(src, hist)
+        else:
+            hist = channel_histograms(src)
+        lut = autocontrast_lut(hist)
+    else:
+        lut = np.tile(IDENTITY_LUT, (3, 1))
+
+    buffer = np.empty_like(src)
+    spare = np.empty_like(src)
+    if config.get('denoise', False):
+        median(src, spare)
+        src = spare
+
+    color = np.float32(config.get('color_enhance', 1.0))
+    contrast = config.get('contrast', 1.0)
+    brightness = config.get('brightness', 1.0)
+    if contrast != 1.0:
+        # 退化图像为 Color 之后的灰度均值，需要先完成前面的点运算
+        total = point(src, lut, color, IDENTITY_LUT, buffer)
+        mean = int(total / max(height * width, 1) + 0.5)
+        levels = level_lut(contrast, brightness, mean)
+        point(buffer, np.tile(levels, (3, 1)), np.float32(1.0), IDENTITY_LUT, buffer)
+    else:
+        point(src, lut, color, level_lut(1.0, brightness), buffer)
+
+    if spare is src:
+        spare = np.empty_like(buffer)
+    if min(height, width) >= 3:
+        sharpen = config.get('sharpen', 1.0)
+        if sharpen > 1.0:
+            filter3x3(buffer, SMOOTH_KERNEL, np.float32(sharpen), spare)
+            buffer, spare = spare, buffer
+        if config.get('edge_enhance', False):
+            filter3x3(buffer, EDGE_ENHANCE_KERNEL, np.float32(0.0), spare)
+            buffer, spare = spare, buffer
+    return buffer
+
+
+def _optimize_colors_numpy(src, out):
+    """NumPy 实现：按行分块做向量化运算，临时数组只有一个块的大小"""
+    for start in range(0, src.shape[0], OPTIMIZE_BLOCK_ROWS):
+        block = src[start:start + OPTIMIZE_BLOCK_ROWS].astype(np.float32)
+        r, g, b = block[..., 0], block[..., 1], block[..., 2]
+        high = np.maximum(np.maximum(r, g), b)
+        strong = (high - np.minimum(np.minimum(r, g), b)) > STRONG_COLOR_SPREAD
+
+        red = strong & (r == high)
+        green = strong & (g == high) & ~red
+        blue = strong & ~red & ~green
+        for mask, channel in ((red, 0), (green, 1), (blue, 2)):
+            enhanced = np.minimum(255, block[mask, channel] * ENHANCE_FACTOR)
+            block[mask] *= REDUCE_FACTOR
+            block[mask, channel] = enhanced
+
+        block[(r > 200) & (g > 200) & (b < 50)] = [255, 255, 0]
+        block[(r > 200) & (g < 100) & (b < 100)] = [255, 0, 0]
+        block[(r < 100) & (g > 200) & (b < 100)] = [0, 255, 0]
+        block[(r < 100) & (g < 100) & (b > 200)] = [0, 0, 255]
+        out[start:start + OPTIMIZE_BLOCK_ROWS] = block
+
+
+def optimize_colors(img_array, out=None, engine=None):
+    """优化颜色以适应6色显示，返回 (H, W, 3) uint8 数组
+
+    逐像素单遍处理，不分配整帧的临时数组；out 为输出缓冲区，可以是 img_array
+    本身（原地处理），为 None 时新分配。
+    engine: None 自动选择；'numba' 编译内核；'numpy' NumPy 实现
+    """
+    if engine is None:
+        engine = 'numba' if HAVE_NUMBA else 'numpy'
+    if engine == 'numba' and not HAVE_NUMBA:
+        raise RuntimeError('未安装 numba，无法使用编译内核')
+
+    src = np.ascontiguousarray(img_array, dtype=np.uint8)
+    if out is None:
+        out = np.empty_like(src)
+    if engine == 'numba':
+        _optimize_colors_compiled(src, out)
+    else:
+        _optimize_colors_numpy(src, out)
+    return out
@@ -0,0 +1,92 @@
+#encoding: utf-8
+"""批量最近调色板颜色匹配
+
+把 (N, 3) 像素数组一次性映射为调色板索引，按块处理以限制临时内存。
+距离计算与 find_nearest_color 完全一致（float32平方距离，相同距离取第一个），
+因此可以直接替换逐像素循环。
+weighted_color_indices、lab_color_indices、ciede2000_color_indices 为感知色差的
+匹配（见 convnew.lut.METRICS），对 uint8 输入通常经由预先计算的查找表使用。
+"""
+
+import numpy as np
+
+from convnew.colorspace import srgb_to_lab, delta_e2000
+
+# 每块像素数：块内临时数组约为 chunk_size * 4 字节 * 若干个
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+
+def nearest_color_indices(pixels, colors, chunk_size=DEFAULT_CHUNK_SIZE):
+    """返回每个像素最近的调色板索引（uint8，形状与输入去掉最后一维相同）"""
+    pixels = np.asarray(pixels)
+    shape = pixels.shape[:-1]
+    flat = pixels.reshape(-1, 3)
+    colors = np.asarray(colors, dtype=np.float32)
+    indices = np.empty(flat.shape[0], dtype=np.uint8)
+
+    for start in range(0, flat.shape[0], chunk_size):
+        chunk = flat[start:start + chunk_size].astype(np.float32)
+        r, g, b = chunk[:, 0], chunk[:, 1], chunk[:, 2]
+        best_dist = np.full(chunk.shape[0], np.inf, dtype=np.float32)
+        best = indices[start:start + chunk_size]
+        best[:] = 0
+        dist = np.empty_like(best_dist)
+        tmp = np.empty_like(best_dist)
+        for k, (cr, cg, cb) in enumerate(colors):
+            # (c - p)^2 按 r、g、b 顺序累加，与 np.sum(axis=1) 的求和顺序一致
+            np.subtract(cr, r, out=dist)
+            np.square(dist, out=dist)
+            np.subtract(cg, g, out=tmp)
+            np.square(tmp, out=tmp)
+            dist += tmp
+            np.subtract(cb, b, out=tmp)
+            np.square(tmp, out=tmp)
+            dist += tmp
+            closer = dist < best_dist
+            best[closer] = k
+            np.copyto(best_dist, dist, where=closer)
+
+    return indices.reshape(shape)
+
+
+def _nearest_indices(pixels, palette, transform, distance, chunk_size):
+    """通用的最近颜色匹配
+
+    transform 把像素块 (n, 3) 转换到比较用的空间，palette 为同一空间中的调色板；
+    distance(转换后的像素块, 一个调色板颜色) 返回 (n,) 距离。相同距离取第一个。
+    """
+    pixels = np.asarray(pixels)
+    shape = pixels.shape[:-1]
+    flat = pixels.reshape(-1, 3)
+    indices = np.empty(flat.shape[0], dtype=np.uint8)
+    for start in range(0, flat.shape[0], chunk_size):
+        features = transform(flat[start:start + chunk_size])
+        dist = np.stack([distance(features, color) for color in palette], axis=1)
+        indices[start:start + chunk_size] = np.argmin(dist, axis=1)
+    return indices.reshape(shape)
+
+
+def _redmean_distance(pixels, color):
+    d = pixels - color
+    rmean = (pixels[:, 0] + color[0]) / 2
+    return (2 + rmean / 256) * d[:, 0] ** 2 + 4 * d[:, 1] ** 2 + (2 + (255 - rmean) / 256) * d[:, 2] ** 2
+
+
+def _squared_distance(pixels, color):
+    return np.sum((pixels - color) ** 2, axis=1)
+
+
+def weighted_color_indices(pixels, colors, chunk_size=DEFAULT_CHUNK_SIZE):
+    """加权 RGB 距离（"redmean" 近似：按两色红色分量的均值调整 R、B 的权重）"""
+    return _nearest_indices(pixels, np.asarray(colors, dtype=np.float64),
+                            lambda chunk: chunk.astype(np.float64), _redmean_distance, chunk_size)
+
+
+def lab_color_indices(pixels, colors, chunk_size=DEFAULT_CHUNK_SIZE):
+    """CIELAB 空间的欧氏距离（CIE76 ΔE）"""
+    return _nearest_indices(pixels, srgb_to_lab(colors), srgb_to_lab, _squared_distance, chunk_size)
+
+
+def ciede2000_color_indices(pixels, colors, chunk_size=DEFAULT_CHUNK_SIZE):
+    """CIEDE2000 色差"""
+    return _nearest_indices(pixels, srgb_to_lab(colors), srgb_to_lab, delta_e2000, chunk_size)
@@ -0,0 +1,378 @@
+#encoding: utf-8
+"""convnew serve：常驻的转换服务（本机 HTTP 或 Unix 套接字）
+
+每次运行 python -m convnew.main 都要重新导入 NumPy/PIL、加载查找表、编译或加载
+numba 内核。服务进程启动时把这些都准备好，之后每个请求只做转换本身：
+
+    POST /convert?palette=e6&method=floyd&preset=photo&format=bmp   请求体为图像字节
+    → 200，响应体为固件文件字节（format 见 encode_output）
+    GET /health → 服务状态（JSON）
+
+同时转换的请求数不超过 workers，另有最多 queue 个请求排队等待；队列满时立即
+返回 503，由调用方稍后重试。numba 内核不持有GIL，Pillow 和 NumPy 的大块运算也会
+释放GIL，因此工作线程可以真正并行。
+"""
+
+import argparse
+import json
+import math
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from convnew import __version__
+from convnew.dither import DIFFUSION_KERNELS
+from convnew.lut import METRICS, get_lut
+from convnew.main import (
+    PRESETS, build_config, convert_bytes, convert_indices,
+)
+from convnew.ordered import THRESHOLD_MAPS, threshold_map
+from convnew.palette import BUILTIN_PALETTES, get_palette
+from convnew.preprocess import FACTOR_RANGE
+
+DEFAULT_PORT = 8765
+DEFAULT_QUEUE = 16
+DEFAULT_MAX_MB = 32
+# 连接上单次读写的超时，同时也是读完整个请求体的期限（秒）：
+# 缓慢或停止发送的客户端不能一直占用名额
+REQUEST_TIMEOUT = 30
+# 读取请求体时每次最多读取的字节数
+READ_CHUNK = 1 << 16
+
+METHODS = list(DIFFUSION_KERNELS) + ['ordered', 'knoll', 'none']
+OUTPUT_FORMATS = {
+    'bmp': 'image/bmp',
+    'packed': 'application/octet-stream',
+    'raw': 'application/octet-stream',
+}
+
+# 请求参数：名称 → (可选值或类型, 默认值)
+OPTIONS = {
+    'method': (METHODS, 'floyd'),
+    'preset': (list(PRESETS), 'photo'),
+    'dir': (['landscape', 'portrait', 'auto'], 'auto'),
+    'mode': (['fit', 'fill', 'stretch'], 'fit'),
+    'metric': (list(METRICS), 'rgb'),
+    'threshold_map': (list(THRESHOLD_MAPS), 'bayer4'),
+    'format': (list(OUTPUT_FORMATS), 'bmp'),
+    'serpentine': (bool, False),
+    'enhance': (float, None),
+    'contrast': (float, None),
+    'brightness': (float, None),
+}
+
+
+def parse_options(query, palettes):
+    """把查询参数解析为转换选项，无效时抛出 ValueError"""
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    unknown = set(params) - set(OPTIONS) - {'palette'}
+    if unknown:
+        raise ValueError(f'未知的参数: {", ".join(sorted(unknown))}')
+
+    options = {}
+    for name, (kind, default) in OPTIONS.items():
+        value = params.get(name)
+        if value is None:
+            options[name] = default
+        elif kind is bool:
+            options[name] = value.lower() in ('1', 'true', 'yes', 'on')
+        elif kind is float:
+            try:
+                number = float(value)
+            except ValueError:
+                raise ValueError(f'参数 {name} 应为数字: {value}') from None
+            # nan/inf 也能被 float() 解析，在读取请求体之前拒绝
+            lo, hi = FACTOR_RANGE
+            if not math.isfinite(number) or not lo <= number <= hi:
+                raise ValueError(f'参数 {name} 应在 {lo:g} 到 {hi:g} 之间: {value}')
+            options[name] = number
+        elif value in kind:
+            options[name] = value
+        else:
+            raise ValueError(f'参数 {name} 无效: {value}（可选: {", ".join(kind)}）')
+
+    palette = params.get('palette', 'e6')
+    if palette not in palettes:
+        raise ValueError(f'未知的调色板: {palette}（可选: {", ".join(palettes)}）')
+    options['palette'] = palettes[palette]
+    return options
+
+
+def convert_request(data, options):
+    """按解析后的选项转换一张图像，返回输出文件字节"""
+    config = build_config(options['preset'], enhance=options['enhance'],
+                          contrast=options['contrast'], brightness=options['brightness'])
+    return convert_bytes(data, palette=options['palette'], output_format=options['format'],
+                         method=options['method'], direction=options['dir'],
+                         mode=options['mode'], config=config, metric=options['metric'],
+                         serpentine=options['serpentine'],
+                         threshold_map=options['threshold_map'])
+
+
+def warm_up(palettes, log=print):
+    """加载每种距离度量的查找表和阈值图，并用一张小图触发每种方法的内核编译
+
+    lab/ciede2000 的表首次生成需要数秒到数十秒，之后从磁盘缓存加载。
+    """
+    started = time.perf_counter()
+    sample = np.zeros((16, 16, 3), dtype=np.uint8)
+    sample[:, :, 0] = np.arange(16) * 16
+    for palette in palettes.values():
+        for metric in METRICS:
+            get_lut(palette['match'], metric)
+        for method in METHODS:
+            convert_indices(sample, palette=palette, method=method, preset='photo',
+                            direction='landscape', mode='stretch')
+    for name in THRESHOLD_MAPS:
+        threshold_map(name)
+    log(f'预热完成: {len(palettes)} 个调色板, {(time.perf_counter() - started):.1f} 秒')
+
+
+class ConvertHandler(BaseHTTPRequestHandler):
+    """处理 /convert 和 /health 请求；服务状态保存在 self.server.state 中"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = f'convnew/{__version__}'
+    timeout = REQUEST_TIMEOUT
+
+    def send_body(self, status, body, content_type, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, data, headers=()):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_body(status, body, 'application/json; charset=utf-8', headers)
+
+    def send_error_json(self, status, message, headers=()):
+        # 请求体可能没有读完，回应后关闭连接
+        self.close_connection = True
+        self.send_json(status, {'error': message}, headers)
+
+    def read_body(self, length, deadline):
+        """在 deadline（time.monotonic()）之前读完 length 字节的请求体
+
+        超时返回 None；客户端提前断开时返回已读到的部分。每次读取之前把套接字
+        超时缩短为剩余时间，因此每隔一段时间只发一个字节的客户端也会在期限处被断开。
+        """
+        chunks, remaining = [], length
+        try:
+            while remaining > 0:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return None
+                self.connection.settimeout(left)
+                chunk = self.rfile.read1(min(remaining, READ_CHUNK))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                remaining -= len(chunk)
+        except socket.timeout:
+            return None
+        finally:
+            self.connection.settimeout(self.timeout)
+        return b''.join(chunks)
+
+    def do_GET(self):
+        state = self.server.state
+        if urlsplit(self.path).path != '/health':
+            self.send_error_json(404, f'未知的路径: {self.path}')
+            return
+        with state['lock']:
+            self.send_json(200, {
+                'status': 'ok', 'version': __version__, 'workers': state['workers'],
+                'queue': state['queue'], 'active': state['active'], 'waiting': state['waiting'],
+                'served': state['served'], 'rejected': state['rejected'], 'failed': state['failed'],
+                'palettes': list(state['palettes']),
+            })
+
+    def do_POST(self):
+        state = self.server.state
+        url = urlsplit(self.path)
+        if url.path != '/convert':
+            self.send_error_json(404, f'未知的路径: {url.path}')
+            return
+        try:
+            options = parse_options(url.query, state['palettes'])
+        except ValueError as e:
+            self.send_error_json(400, str(e))
+            return
+
+        length = self.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            self.send_error_json(411, '需要 Content-Length')
+            return
+        if int(length) > state['max_bytes']:
+            self.send_error_json(413, f'图像超过 {state["max_bytes"] >> 20} MB')
+            return
+
+        # 正在转换和排队的请求总数有上限；队列满时不读请求体，直接拒绝
+        if not state['slots'].acquire(blocking=False):
+            with state['lock']:
+                state['rejected'] += 1
+            self.send_error_json(503, '服务繁忙，请稍后重试', [('Retry-After', '1')])
+            return
+        try:
+            data = self.read_body(int(length), time.monotonic() + REQUEST_TIMEOUT)
+            if data is None:
+                self.send_error_json(408, f'请求体没有在 {REQUEST_TIMEOUT} 秒内发完')
+                return
+            with state['lock']:
+                state['waiting'] += 1
+            with state['workers_free']:
+                with state['lock']:
+                    state['waiting'] -= 1
+                    state['active'] += 1
+                started = time.perf_counter()
+                try:
+                    body = convert_request(data, options)
+                finally:
+                    with state['lock']:
+                        state['active'] -= 1
+            elapsed = (time.perf_counter() - started) * 1000
+        except Exception as e:
+            with state['lock']:
+                state['failed'] += 1
+            # 无法解码的图像（PIL 抛出 OSError 的子类）或无效数据属于请求错误
+            status = 400 if isinstance(e, (OSError, ValueError)) else 500
+            self.send_error_json(status, f'转换失败: {e}')
+            return
+        finally:
+            state['slots'].release()
+
+        with state['lock']:
+            state['served'] += 1
+        self.send_body(200, body, OUTPUT_FORMATS[options['format']],
+                       [('X-Convert-Time-Ms', f'{elapsed:.1f}')])
+
+    def address_string(self):
+        # Unix 套接字的客户端地址为空字符串
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.state['verbose']:
+            self.server.state['log'](f'{self.address_string()} {format % args}')
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix 套接字上的多线程 HTTP 服务"""
+
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def new_state(palettes, workers, queue_size, max_bytes, verbose=False, log=print):
+    """服务状态：并发限制、计数器和已加载的调色板"""
+    return {
+        'palettes': palettes, 'workers': workers, 'queue': queue_size, 'max_bytes': max_bytes,
+        'slots': threading.BoundedSemaphore(workers + queue_size),
+        'workers_free': threading.BoundedSemaphore(workers),
+        'lock': threading.Lock(), 'active': 0, 'waiting': 0,
+        'served': 0, 'rejected': 0, 'failed': 0, 'verbose': verbose, 'log': log,
+    }
+
+
+def make_server(state, host='127.0.0.1', port=DEFAULT_PORT, socket_path=None):
+    """创建 HTTP 服务（给出 socket_path 时监听 Unix 套接字）"""
+    if socket_path:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError('此平台不支持 Unix 套接字，请使用 --port')
+        # 删除上次异常退出留下的套接字文件
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, ConvertHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ConvertHandler)
+        server.daemon_threads = True
+    server.state = state
+    return server
+
+
+def load_palettes(paths):
+    """内置调色板和 --palette 指定的调色板文件：名称 → 调色板"""
+    palettes = {name: get_palette(name) for name in BUILTIN_PALETTES}
+    for path in paths:
+        palette = get_palette(path)
+        palettes[palette['name']] = palette
+    return palettes
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='convnew serve',
+        description='常驻转换服务：保持内核、查找表和调色板常驻内存，通过本机 HTTP 或 Unix 套接字转换图像',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='''
+请求示例:
+  curl --data-binary @photo.jpg -o photo_e6.bmp 'http://127.0.0.1:8765/convert?palette=e6&preset=photo'
+  curl --unix-socket /tmp/convnew.sock --data-binary @a.png -o a.bmp 'http://localhost/convert?method=ordered'
+  curl http://127.0.0.1:8765/health
+    ''')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址（默认只接受本机连接）')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'监听端口（默认 {DEFAULT_PORT}）')
+    parser.add_argument('--socket', metavar='PATH', help='改为监听 Unix 套接字')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='同时转换的请求数（默认为CPU核心数）')
+    parser.add_argument('--queue', type=int, default=DEFAULT_QUEUE,
+                        help=f'最多排队等待的请求数，超出时返回 503（默认 {DEFAULT_QUEUE}）')
+    parser.add_argument('--max-mb', type=int, default=DEFAULT_MAX_MB,
+                        help=f'单个请求图像的大小上限（默认 {DEFAULT_MAX_MB} MB）')
+    parser.add_argument('--palette', action='append', default=[], metavar='FILE',
+                        help='额外加载的 .json/.gpl 调色板文件，请求中按调色板名称使用（可重复）')
+    parser.add_argument('--no-warmup', action='store_true', help='启动时不预热')
+    parser.add_argument('--verbose', '-v', action='store_true', help='记录每个请求')
+    return parser
+
+
+def main(argv=None):
+    """serve 子命令入口"""
+    args = build_parser().parse_args(argv)
+    if args.workers < 1 or args.queue < 0:
+        print('错误：--workers 至少为 1，--queue 不能为负数')
+        return 1
+    try:
+        palettes = load_palettes(args.palette)
+    except ValueError as e:
+        print(f'错误：{e}')
+        return 1
+
+    if not args.no_warmup:
+        warm_up(palettes)
+    state = new_state(palettes, args.workers, args.queue, args.max_mb << 20, args.verbose)
+    try:
+        server = make_server(state, args.host, args.port, args.socket)
+    except (OSError, ValueError) as e:
+        print(f'错误：无法监听: {e}')
+        return 1
+
+    where = args.socket or f'http://{args.host}:{args.port}'
+    print(f'convnew {__version__} 服务已启动: {where}（工作线程 {args.workers} 个, 队列 {args.queue}）')
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\n服务已停止')
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
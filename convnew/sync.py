@@ -0,0 +1,127 @@
+#encoding: utf-8
+"""目录增量同步（--sync）的清单文件
+
+清单保存在输出目录中（指定了 --output-dir 时），否则保存在输入目录中，记录每个源文件的
+mtime、大小、SHA-256、转换设置的哈希以及生成的输出文件。再次运行时：
+- mtime 和大小都未变且设置相同的文件直接跳过（不读取内容）；
+- mtime 或大小变化但内容哈希相同的文件只更新清单；
+- 新文件、内容变化或设置变化的文件重新转换；
+- 源文件已删除的条目，删除其输出文件并移出清单。
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+MANIFEST_NAME = '.convnew-manifest.json'
+MANIFEST_VERSION = 1
+
+
+def file_digest(path, block_size=1 << 20):
+    """文件内容的 SHA-256（分块读取）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def settings_digest(settings):
+    """转换设置的哈希（settings 必须可以序列化为JSON）"""
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _relpath(path, directory):
+    return os.path.relpath(path, directory).replace(os.sep, '/')
+
+
+def _abspath(relpath, directory):
+    return os.path.join(directory, *relpath.split('/'))
+
+
+def load_manifest(directory):
+    """读取清单；不存在、损坏或版本不符时返回空清单"""
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION and isinstance(manifest.get('files'), dict):
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {'version': MANIFEST_VERSION, 'files': {}}
+
+
+def save_manifest(directory, manifest):
+    """原子写入清单（目录不存在时先创建，例如尚未生成任何输出的 --output-dir）"""
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, os.path.join(directory, MANIFEST_NAME))
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+
+def _remove_outputs(directory, outputs, keep=()):
+    """删除清单中记录的输出文件（keep 中的除外），返回删除的文件数"""
+    removed = 0
+    for relpath in outputs:
+        if relpath in keep:
+            continue
+        try:
+            os.remove(_abspath(relpath, directory))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def remove_stale(directory, image_files, manifest):
+    """删除源文件已不存在的条目及其输出文件，返回删除的输出文件数
+
+    image_files 只是本次扫描到的文件；不在其中的条目可能只是超出了本次的扫描范围
+    （未加 -r、--include/--exclude 不同），源文件仍在磁盘上时保留条目和输出文件。
+    """
+    present = {_relpath(path, directory) for path in image_files}
+    removed = 0
+    for relpath in list(manifest['files']):
+        if relpath in present or os.path.exists(_abspath(relpath, directory)):
+            continue
+        removed += _remove_outputs(directory, manifest['files'].pop(relpath).get('outputs', []))
+    return removed
+
+
+def plan_sync(directory, image_files, manifest, settings_hash):
+    """找出需要转换的文件，返回 (待转换文件列表, {文件: 指纹})
+
+    指纹为 {'mtime', 'size', 'sha256'}，转换成功后传给 update_entry()。
+    只有 mtime 变化而内容相同的文件在这里直接更新清单，不需要转换。
+    """
+    pending, fingerprints = [], {}
+    for path in image_files:
+        entry = manifest['files'].get(_relpath(path, directory))
+        st = os.stat(path)
+        same_settings = entry is not None and entry.get('settings') == settings_hash
+        if same_settings and entry['mtime'] == st.st_mtime and entry['size'] == st.st_size:
+            continue
+
+        fingerprint = {'mtime': st.st_mtime, 'size': st.st_size, 'sha256': file_digest(path)}
+        if same_settings and entry['sha256'] == fingerprint['sha256']:
+            entry.update(fingerprint)
+            continue
+        pending.append(path)
+        fingerprints[path] = fingerprint
+    return pending, fingerprints
+
+
+def update_entry(directory, manifest, path, fingerprint, settings_hash, outputs):
+    """记录转换成功的文件；上次的输出中本次不再生成的（如换了调色板）会被删除"""
+    relpath = _relpath(path, directory)
+    outputs = [_relpath(output, directory) for output in outputs]
+    previous = manifest['files'].get(relpath)
+    if previous:
+        _remove_outputs(directory, previous.get('outputs', []), keep=outputs)
+    manifest['files'][relpath] = dict(fingerprint, settings=settings_hash, outputs=outputs)
@@ -0,0 +1,68 @@
+#encoding: utf-8
+"""流式目录遍历
+
+用 os.scandir 逐个目录遍历，边找到边产生文件路径，不先收集整棵目录树；
+内存占用只与目录深度和单个目录的条目数有关。每个目录内按名称排序，
+因此产生的顺序是确定的。
+"""
+
+import fnmatch
+import os
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def _matches(relpath, patterns):
+    """相对路径或文件名匹配任一通配符（大小写不敏感）"""
+    name = relpath.rsplit('/', 1)[-1]
+    return any(fnmatch.fnmatch(relpath.lower(), p) or fnmatch.fnmatch(name.lower(), p)
+               for p in patterns)
+
+
+def iter_image_files(root, recursive=False, include=None, exclude=None,
+                     extensions=IMAGE_EXTENSIONS, skip_dirs=()):
+    """逐个产生 root 下的图片文件路径
+
+    include/exclude 为通配符列表，匹配相对 root 的路径（'/' 分隔）或文件名；
+    exclude 也用于整个跳过子目录。skip_dirs 中的目录（如位于输入目录内的
+    输出目录）不会被遍历。
+    """
+    include = [p.lower() for p in include or []]
+    exclude = [p.lower() for p in exclude or []]
+    skip_dirs = {os.path.normcase(os.path.realpath(d)) for d in skip_dirs}
+
+    # 显式栈代替递归，待遍历的只是目录路径
+    stack = [(root, '')]
+    while stack:
+        directory, prefix = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:  # 无权限或遍历期间被删除
+            continue
+
+        subdirs = []
+        for entry in entries:
+            relpath = prefix + entry.name
+            try:
+                # 不跟随目录的符号链接，避免循环
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_dir:
+                if not recursive or _matches(relpath, exclude):
+                    continue
+                if skip_dirs and os.path.normcase(os.path.realpath(entry.path)) in skip_dirs:
+                    continue
+                subdirs.append((entry.path, relpath + '/'))
+                continue
+            if not entry.name.lower().endswith(extensions):
+                continue
+            if include and not _matches(relpath, include):
+                continue
+            if exclude and _matches(relpath, exclude):
+                continue
+            yield entry.path
+
+        # 先处理本目录的文件，再按名称顺序进入子目录
+        stack.extend(reversed(subdirs))